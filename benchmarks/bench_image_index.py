@@ -0,0 +1,74 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import data_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 4000, 16000, 32000]
+    )
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+    return args
+
+
+def make_records(n):
+    image_ids = random.sample(range(10 ** 9), n)
+    captions = [{"id": image_id} for image_id in image_ids]
+    annotations = [{"image": str(image_id)} for image_id in image_ids]
+    return image_ids, captions, annotations
+
+
+def scan_lookup(image_id, train_image_ids, captions, annotations):
+    is_train = int(image_id) in train_image_ids
+    caption_idx = [
+        idx for idx in range(len(captions)) if captions[idx]["id"] == int(image_id)
+    ][0]
+    phrase_file = [
+        idx
+        for idx in range(len(annotations))
+        if annotations[idx]["image"] == str(image_id)
+    ]
+    return is_train, caption_idx, annotations[phrase_file[0]]
+
+
+def index_lookup(image_id, train_image_id_set, caption_index, annotations, annotation_index):
+    is_train = int(image_id) in train_image_id_set
+    caption_idx = caption_index[int(image_id)]
+    return is_train, caption_idx, annotations[annotation_index[str(image_id)]]
+
+
+def time_per_item(fn, queries):
+    t = time.perf_counter()
+    for image_id in queries:
+        fn(image_id)
+    return (time.perf_counter() - t) / len(queries)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("%10s %16s %16s" % ("images", "scan us/item", "index us/item"))
+    for n in args.sizes:
+        image_ids, captions, annotations = make_records(n)
+        train_image_id_set = set(image_ids)
+        caption_index = data_utils.build_first_index(c["id"] for c in captions)
+        annotation_index = data_utils.build_first_index(a["image"] for a in annotations)
+        queries = random.choices(image_ids, k=args.lookups)
+
+        scan = time_per_item(
+            lambda i: scan_lookup(i, image_ids, captions, annotations), queries
+        )
+        indexed = time_per_item(
+            lambda i: index_lookup(
+                i, train_image_id_set, caption_index, annotations, annotation_index
+            ),
+            queries,
+        )
+        print("%10d %16.2f %16.2f" % (n, scan * 1e6, indexed * 1e6))
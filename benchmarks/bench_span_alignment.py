@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import data_utils
+from data import span_alignment
+
+WORDS = ["word%d" % i for i in range(2000)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[64, 256, 512, 2048])
+    parser.add_argument("--phrases", type=int, default=40, help="phrases per caption")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+    return args
+
+
+def make_caption(n_tokens, n_phrases):
+    # whitespace tokens stand in for wordpieces; offsets are their char spans
+    tokens = [random.choice(WORDS) for _ in range(n_tokens)]
+    offsets = []
+    pos = 0
+    for token in tokens:
+        offsets.append([pos, pos + len(token)])
+        pos += len(token) + 1
+    caption = " ".join(tokens)
+
+    starts = sorted(random.sample(range(n_tokens - 3), min(n_phrases, n_tokens - 3)))
+    phrases, start_end, phrase_tokens = [], [], {}
+    for start in starts:
+        end = start + random.randint(1, 3)
+        phrase = caption[offsets[start][0] : offsets[end - 1][1]]
+        phrases.append(phrase)
+        start_end.append([offsets[start][0], offsets[end - 1][1]])
+        phrase_tokens[phrase] = tokens[start:end]
+    return tokens, np.array(offsets), phrases, start_end, phrase_tokens
+
+
+def sublist_spans(tokens, phrases, phrase_tokens):
+    spans = []
+    char_indx = -1
+    for phrase in phrases:
+        start, end, char_indx = data_utils.find_sublist(
+            tokens, phrase_tokens[phrase], char_indx + 1
+        )
+        spans.append([start, end])
+    return spans
+
+
+def offset_spans(offsets, phrases, start_end):
+    return span_alignment.char_to_token_spans(
+        offsets, span_alignment.phrase_char_spans(start_end, phrases)
+    )
+
+
+def time_per_call(fn, repeats):
+    t = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t) / repeats
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("%10s %18s %18s %10s" % ("tokens", "find_sublist us", "offsets us", "agree"))
+    for n in args.lengths:
+        tokens, offsets, phrases, start_end, phrase_tokens = make_caption(
+            n, args.phrases
+        )
+        reference = sublist_spans(tokens, phrases, phrase_tokens)
+        aligned = offset_spans(offsets, phrases, start_end).tolist()
+        agree = sum(r == a for r, a in zip(reference, aligned)) / max(len(phrases), 1)
+
+        scan = time_per_call(
+            lambda: sublist_spans(tokens, phrases, phrase_tokens), args.repeats
+        )
+        vectorized = time_per_call(
+            lambda: offset_spans(offsets, phrases, start_end), args.repeats
+        )
+        print("%10d %18.1f %18.1f %10.2f" % (n, scan * 1e6, vectorized * 1e6, agree))
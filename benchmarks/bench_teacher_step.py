@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+from types import SimpleNamespace
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.ema import ModelEMA
+from models.mcr import BertPretrain
+from models.pseudo_label import TeacherCache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_config", type=str, required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--batch", type=int, default=8)
+    parser.add_argument("--num_objects", type=int, default=128)
+    parser.add_argument("--num_queries", type=int, default=128)
+    parser.add_argument("--caption_length", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--ema-decay", default=0.999, type=float)
+    parser.add_argument("--text_encoder", type=str, default="bert-base-uncased")
+    parser.add_argument(
+        "--refresh", type=int, nargs="+", default=[2, 4], help="--teacher-refresh values"
+    )
+    args = parser.parse_args()
+    return args
+
+
+def make_batch(args, config, tokenizer):
+    B, O, Q, L = args.batch, args.num_objects, args.num_queries, args.caption_length
+    vocab_size = tokenizer.vocab_size
+    start = torch.randint(0, L - 4, (B, Q))
+    start_end = torch.stack((start, start + torch.randint(1, 4, (B, Q))), dim=-1)
+    # object labels are flat (B * O, 16) rows, as train.py passes them
+    return dict(
+        image_features=torch.randn(B, O, config["img_dim"]),
+        object_label_input_ids=torch.randint(1000, vocab_size, (B * O, 16)),
+        object_label_attention_mask=torch.ones(B * O, 16, dtype=torch.long),
+        object_regions=torch.rand(B, O, 5),
+        text_input_ids=torch.randint(1000, vocab_size, (B, L)),
+        text_attention_mask=torch.ones(B, L, dtype=torch.long),
+        sense2vec_feats=torch.randn(B, L, 128),
+        q_start_ind=start_end,
+        num_objects=torch.full((B,), O, dtype=torch.long),
+        num_query=torch.full((B,), Q, dtype=torch.long),
+    )
+
+
+def to_device(batch, device):
+    return {k: v.to(device) for k, v in batch.items()}
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def step_loss(outputs, targets):
+    loss = sum(
+        o.float().mean() for o in outputs if torch.is_tensor(o) and o.requires_grad
+    )
+    return loss + sum(
+        ((o - t) ** 2).mean() for o, t in zip((outputs[2], outputs[3]), targets)
+    )
+
+
+def step(model, optimizer, batch, mode, teacher=None, cache=None):
+    """One label propagation step; mode is forward, ema or ema-cached."""
+    image_ids = torch.arange(batch["num_query"].size(0))
+    if mode == "ema-cached":
+        targets = cache.lookup(
+            image_ids, 0, batch["q_start_ind"].size(1), batch["image_features"].size(1),
+            batch["num_query"].device,
+        )
+    else:
+        with torch.no_grad():
+            targets = teacher(**batch, train=False, inference=True)[2:4]
+        if cache is not None:
+            cache.store(image_ids, 0, *targets, batch["num_query"], batch["num_objects"])
+    outputs = model(**batch)
+    loss = step_loss(outputs, targets)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+def time_mode(args, model, batch, mode):
+    params = [p for p in model.parameters() if p.requires_grad]
+    teacher, ema, cache = model, None, None
+    if mode.startswith("ema"):
+        ema = ModelEMA(args, model, args.ema_decay)
+        teacher = ema.ema
+        cache = TeacherCache(refresh_epochs=1)
+        # fill the cache so that every ema-cached step is a hit
+        step(model, torch.optim.SGD(params, lr=0.0), batch, "ema", teacher, cache=cache)
+    optimizer = torch.optim.SGD(params, lr=1e-6)
+    for i in range(args.warmup + args.steps):
+        if i == args.warmup:
+            synchronize()
+            t = time.perf_counter()
+        step(model, optimizer, batch, mode, teacher, cache)
+        if ema is not None:
+            ema.update(model)
+    synchronize()
+    return (time.perf_counter() - t) / args.steps
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = json.load(open(args.model_config, "rb"))
+    model_args = SimpleNamespace(
+        bbox_reg=False,
+        trans_func="linear",
+        use_ssl=True,
+        use_phrase_mask=True,
+        adaptor_layers=1,
+        ssl_loss="mse",
+    )
+    device = torch.device(args.device)
+    model = BertPretrain(
+        text_encoder=args.text_encoder, config=config, args=model_args
+    ).to(device)
+    model.train()
+    batch = make_batch(args, config, model.tokenizer)
+    batch = to_device(batch, device)
+    initial_state = deepcopy(model.state_dict())
+
+    timings = {}
+    print("%12s %16s" % ("teacher", "ms/step"))
+    for mode in ("forward", "ema", "ema-cached"):
+        model.load_state_dict(initial_state)
+        timings[mode] = time_mode(args, model, batch, mode) * 1e3
+        print("%12s %16.1f" % (mode, timings[mode]))
+    # --teacher-source ema refreshes each image once every --teacher-refresh epochs
+    for refresh in args.refresh:
+        amortized = (timings["ema"] + (refresh - 1) * timings["ema-cached"]) / refresh
+        print("%12s %16.1f" % ("ema/%d" % refresh, amortized))
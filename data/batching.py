@@ -0,0 +1,362 @@
+import math
+from collections import namedtuple
+from dataclasses import dataclass, field, fields, replace
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+from utils import utils
+
+# sample layout returned by LocalizedNarrativesFlickr30dataset.__getitem__; the
+# eval splits append max_assignments. dtype is the compact dtype samples are
+# built, collated and copied in, device_dtype what the model consumes after
+# Batch.to (None: unchanged). pad names the padded group of each leading axis
+# (O: regions, Q: phrase queries, T: target boxes, L: caption tokens, A: max
+# assignments). Eval grounding samples have one target box per (phrase, box)
+# pair, so T is sized separately and does not inflate the query tensors.
+# collate_eval re-expands eval batches to the older 20-field layout of
+# evaluate(), see eval_layout.
+SampleField = namedtuple(
+    "SampleField", ["name", "dtype", "device_dtype", "pad", "pad_value"]
+)
+
+SAMPLE_FIELDS = (
+    SampleField("image_id", torch.int64, None, None, 0),
+    SampleField("phrase_queries", None, None, None, None),
+    SampleField("image_features", torch.float16, torch.float32, ("O",), 0),
+    SampleField("object_label_input_ids", torch.int32, torch.int64, ("O",), 0),
+    SampleField("object_label_attention_mask", torch.bool, torch.int64, ("O",), 0),
+    SampleField("object_regions", torch.float32, None, ("O",), 0),
+    SampleField("phrase_queries_input_ids", torch.int32, torch.int64, ("Q",), 0),
+    SampleField("phrase_queries_attention_mask", torch.bool, torch.int64, ("Q",), 0),
+    SampleField("caption_input_ids", torch.int32, torch.int64, (None, "L"), 0),
+    SampleField("caption_attn_mask", torch.bool, torch.int64, (None, "L"), 0),
+    SampleField("sense2vec_feats", torch.float16, torch.float32, ("L",), 0),
+    SampleField("query_start_end", torch.int16, torch.int64, ("Q",), 0),
+    SampleField("num_objects", torch.int32, torch.int64, None, 0),
+    SampleField("num_query", torch.int32, torch.int64, None, 0),
+    SampleField("target_bboxes", torch.float32, None, ("T",), 0),
+    SampleField("mouse_trace_for_phrases", torch.float32, None, None, 0),
+    SampleField("gt_coref_clusters", torch.int16, torch.int64, ("Q",), -1),
+    SampleField("rule_coref_matrix", torch.uint8, torch.float32, ("Q", "Q"), 0),
+    SampleField("max_assignments", torch.int16, torch.int64, ("A",), 0),
+)
+
+FIELD_INDEX = {spec.name: idx for idx, spec in enumerate(SAMPLE_FIELDS)}
+DEVICE_DTYPES = {
+    spec.name: spec.device_dtype
+    for spec in SAMPLE_FIELDS
+    if spec.device_dtype is not None
+}
+
+# tuple position -> padded group of each axis, and fill value when not zero
+PAD_SPEC = {
+    idx: spec.pad for idx, spec in enumerate(SAMPLE_FIELDS) if spec.pad is not None
+}
+PAD_VALUES = {
+    idx: spec.pad_value
+    for idx, spec in enumerate(SAMPLE_FIELDS)
+    if spec.pad is not None and spec.pad_value != 0
+}
+
+# fields whose length decides the padded size of each group; the other fields
+# of the group are padded or truncated to it
+SIZE_FIELDS = {
+    "O": ((2, 0), (3, 0), (4, 0), (5, 0)),
+    "Q": ((6, 0),),
+    "T": ((14, 0),),
+    "L": ((8, 1),),
+    "A": ((18, 0),),
+}
+
+PHRASE_QUERIES = FIELD_INDEX["phrase_queries"]
+
+
+def compact_sample(sample):
+    """Cast the tensors of a sample to the compact dtypes of SAMPLE_FIELDS."""
+    return tuple(
+        value.to(spec.dtype)
+        if torch.is_tensor(value) and spec.dtype is not None
+        else value
+        for spec, value in zip(SAMPLE_FIELDS, sample)
+    )
+
+
+def pad_to_shape(tensor, shape, value=0):
+    shape = tuple(shape)
+    if tuple(tensor.shape) == shape:
+        return tensor
+    out = tensor.new_full(shape, value)
+    region = tuple(slice(0, min(s, t)) for s, t in zip(tensor.shape, shape))
+    out[region] = tensor[region]
+    return out
+
+
+def batch_sizes(batch):
+    sizes = {}
+    for group, fields in SIZE_FIELDS.items():
+        lengths = [
+            sample[idx].shape[axis]
+            for sample in batch
+            for idx, axis in fields
+            if idx < len(sample)
+        ]
+        if len(lengths) > 0:
+            sizes[group] = max(max(lengths), 1)
+    return sizes
+
+
+def collate_dynamic(batch):
+    sizes = batch_sizes(batch)
+    columns = []
+    for idx in range(len(batch[0])):
+        column = [sample[idx] for sample in batch]
+        if idx == PHRASE_QUERIES:
+            if column[0] is None:
+                columns.append(None)
+                continue
+            num_queries = sizes["Q"]
+            column = [
+                (list(phrases) + [""] * num_queries)[:num_queries] for phrases in column
+            ]
+            columns.append(default_collate(column))
+        elif idx in PAD_SPEC:
+            columns.append(
+                torch.stack(
+                    [
+                        pad_to_shape(
+                            t,
+                            [
+                                t.shape[axis] if group is None else sizes[group]
+                                for axis, group in enumerate(PAD_SPEC[idx])
+                            ]
+                            + list(t.shape[len(PAD_SPEC[idx]) :]),
+                            PAD_VALUES.get(idx, 0),
+                        )
+                        for t in column
+                    ]
+                )
+            )
+        else:
+            columns.append(default_collate(column))
+    return columns
+
+
+def _packed_size(tensor):
+    # byte size rounded up to 8 so that every field starts aligned
+    return -(-tensor.numel() * tensor.element_size() // 8) * 8
+
+
+def _field_view(buffer, offset, like):
+    nbytes = like.numel() * like.element_size()
+    return buffer[offset : offset + nbytes].view(like.dtype).view(like.shape)
+
+
+def _pack(tensors, pin_memory=False):
+    """Copy tensors into one byte buffer; returns it and each tensor's offset."""
+    offsets = np.cumsum([0] + [_packed_size(t) for t in tensors]).tolist()
+    buffer = torch.empty(offsets[-1], dtype=torch.uint8, pin_memory=pin_memory)
+    for t, offset in zip(tensors, offsets):
+        _field_view(buffer, offset, t).copy_(t)
+    return buffer, offsets[:-1]
+
+
+def _same_device(a, b):
+    return a.type == b.type and (a.index is None or b.index is None or a.index == b.index)
+
+
+def _can_pin():
+    # pinning needs CUDA and is left to the DataLoader's pin thread in workers
+    return torch.cuda.is_available() and get_worker_info() is None
+
+
+@dataclass
+class Batch:
+    """A collated batch, one attribute per field of SAMPLE_FIELDS.
+
+    Batch.collate packs the tensors into a single byte buffer, pinned when
+    collating in the main process of a CUDA run, and the fields are views of
+    it. to() copies that buffer to device in one transfer and casts the
+    fields to their device dtypes; pin_memory() lets a DataLoader with
+    pin_memory=True pin it with a single call.
+    """
+
+    image_id: torch.Tensor
+    phrase_queries: Optional[list]
+    image_features: torch.Tensor
+    object_label_input_ids: torch.Tensor
+    object_label_attention_mask: torch.Tensor
+    object_regions: torch.Tensor
+    phrase_queries_input_ids: torch.Tensor
+    phrase_queries_attention_mask: torch.Tensor
+    caption_input_ids: torch.Tensor
+    caption_attn_mask: torch.Tensor
+    sense2vec_feats: torch.Tensor
+    query_start_end: torch.Tensor
+    num_objects: torch.Tensor
+    num_query: torch.Tensor
+    target_bboxes: torch.Tensor
+    mouse_trace_for_phrases: torch.Tensor
+    gt_coref_clusters: torch.Tensor
+    rule_coref_matrix: torch.Tensor
+    max_assignments: Optional[torch.Tensor] = None
+    _buffer: Optional[torch.Tensor] = field(default=None, repr=False, compare=False)
+    _offsets: Optional[dict] = field(default=None, repr=False, compare=False)
+    _device: Optional[torch.device] = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def collate(cls, samples):
+        return cls(*collate_dynamic(samples)).packed(pin_memory=_can_pin())
+
+    def tensors(self):
+        return {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if not f.name.startswith("_") and torch.is_tensor(getattr(self, f.name))
+        }
+
+    def packed(self, pin_memory=False):
+        """This batch with every tensor a view of one (pinned) buffer."""
+        tensors = self.tensors()
+        buffer, offsets = _pack(list(tensors.values()), pin_memory)
+        offsets = dict(zip(tensors, offsets))
+        return replace(self._from_buffer(buffer, offsets), _device=None)
+
+    def _from_buffer(self, buffer, offsets, dtypes=None):
+        views = {
+            name: _field_view(buffer, offset, getattr(self, name))
+            for name, offset in offsets.items()
+        }
+        for name, dtype in (dtypes or {}).items():
+            if name in views:
+                views[name] = views[name].to(dtype)
+        return replace(self, _buffer=buffer, _offsets=offsets, **views)
+
+    def pin_memory(self):
+        if self._buffer is None or self._device is not None:
+            return self.packed(pin_memory=True)
+        if self._buffer.is_pinned():
+            return self
+        return self._from_buffer(self._buffer.pin_memory(), self._offsets)
+
+    def to(self, device, non_blocking=True):
+        device = torch.device(device)
+        if self._device is not None and _same_device(self._device, device):
+            # already moved, e.g. by a PrefetchLoader
+            return self
+        batch = self
+        if batch._buffer is None or batch._device is not None:
+            batch = batch.packed(pin_memory=device.type == "cuda" and _can_pin())
+        buffer = batch._buffer.to(device, non_blocking=non_blocking)
+        moved = batch._from_buffer(buffer, batch._offsets, DEVICE_DTYPES)
+        return replace(moved, _device=buffer.device)
+
+
+def restore_dtypes(batch):
+    """Cast the fields of a batch to the device_dtype of SAMPLE_FIELDS."""
+    return [
+        value.to(spec.device_dtype)
+        if torch.is_tensor(value) and spec.device_dtype is not None
+        else value
+        for spec, value in zip(SAMPLE_FIELDS, batch)
+    ] + list(batch[len(SAMPLE_FIELDS) :])
+
+
+def eval_layout(batch):
+    """The 20-field eval batch evaluate() consumes, from a collated eval batch.
+
+    evaluate() predates the compact schema: it reads a second copy of
+    caption_attn_mask after mouse_trace_for_phrases and a (B, Q, Q) ground
+    truth coref matrix where samples now carry per-phrase cluster ids.
+    """
+    batch = list(batch)
+    gt_coref = FIELD_INDEX["gt_coref_clusters"]
+    caption_attn_mask = batch[FIELD_INDEX["caption_attn_mask"]]
+    batch[gt_coref] = utils.coref_matrix(batch[gt_coref].long())
+    return batch[:gt_coref] + [caption_attn_mask] + batch[gt_coref:]
+
+
+def finish_eval(batch):
+    """Device dtypes and eval_layout of a collate_dynamic eval batch."""
+    return eval_layout(restore_dtypes(batch))
+
+
+def collate_eval(batch):
+    """collate_dynamic in the dtypes and eval_layout evaluate() consumes, for
+    loaders whose batches are moved to device field by field."""
+    return finish_eval(collate_dynamic(batch))
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        drop_last=True,
+        shuffle=True,
+        bucket_size=50,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(self.lengths) / self.num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank_indices(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        total_size = self.num_samples * self.num_replicas
+        if total_size > len(indices):
+            indices = np.concatenate((indices, indices[: total_size - len(indices)]))
+        return indices[self.rank : total_size : self.num_replicas], rng
+
+    def __iter__(self):
+        indices, rng = self._rank_indices()
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), chunk):
+            bucket = indices[start : start + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for b in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[b : b + self.batch_size])
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            rng.shuffle(batches)
+        for b in batches:
+            yield b.tolist()
+
+    def __len__(self):
+        chunk = self.batch_size * self.bucket_size
+        n_batches = 0
+        for start in range(0, self.num_samples, chunk):
+            bucket_len = min(chunk, self.num_samples - start)
+            if self.drop_last:
+                n_batches += bucket_len // self.batch_size
+            else:
+                n_batches += int(math.ceil(bucket_len / self.batch_size))
+        return n_batches
+
+
+def set_epoch(loader, epoch):
+    for sampler in (loader.batch_sampler, loader.sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+            return
@@ -1,15 +1,30 @@
 from __future__ import print_function
 
 
+import os
 import numpy as np
 from scipy import spatial
 import numpy as np
 
 
 class WordEmbeddings:
-    def __init__(self, word_indexer, vectors):
+    def __init__(self, word_indexer, vectors=None, vectors_path=None):
         self.word_indexer = word_indexer
-        self.vectors = vectors
+        self._vectors = vectors
+        self.vectors_path = vectors_path
+
+    @property
+    def vectors(self):
+        # the binary matrix is only mapped once an embedding is actually needed
+        if self._vectors is None and self.vectors_path is not None:
+            self._vectors = np.load(self.vectors_path, mmap_mode="r")
+        return self._vectors
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.vectors_path is not None:
+            state["_vectors"] = None
+        return state
 
     def get_embedding_length(self):
         return len(self.vectors[0])
@@ -63,6 +78,9 @@ class WordIndexer(object):
         else:
             return self.objs_to_ints[object]
 
+    def index_of_many(self, objects):
+        return np.array([self.index_of(o) for o in objects], dtype=np.int64)
+
     def add_and_get_index(self, object, add=True):
         if not add:
             return self.index_of(object)
@@ -73,31 +91,219 @@ class WordIndexer(object):
         return self.objs_to_ints[object]
 
 
-def load_vocabulary(embeddings_file: str) -> WordEmbeddings:
-    f = open(embeddings_file)
-    word_indexer = WordIndexer()
-    vectors = []
+class CompactWordIndexer(object):
+    """Read-only WordIndexer backed by a sorted fixed-width byte-string table.
+
+    words holds the UTF-8 encoded vocabulary in sorted order, ids the index of
+    each sorted entry and ranks the sorted position of each index. Loaded from
+    .npy files the tables are memory-mapped and pickle by path, so DataLoader
+    workers share the pages instead of receiving a copy.
+    """
+
+    def __init__(self, words, ids, ranks, paths=None):
+        self.words = words
+        self.ids = ids
+        self.ranks = ranks
+        self.paths = paths
+
+    @classmethod
+    def from_objects(cls, objects):
+        encoded = np.array([o.encode("utf-8") for o in objects], dtype=np.bytes_)
+        order = np.argsort(encoded, kind="stable")
+        ranks = np.empty(len(order), dtype=np.int32)
+        ranks[order] = np.arange(len(order), dtype=np.int32)
+        return cls(encoded[order], order.astype(np.int32), ranks)
+
+    @classmethod
+    def load(cls, paths):
+        return cls(*[np.load(path, mmap_mode="r") for path in paths], paths=paths)
+
+    def save(self, paths):
+        pid = os.getpid()
+        for path, array in zip(paths, (self.words, self.ids, self.ranks)):
+            tmp_path = "%s.%d.tmp" % (path, pid)
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+
+    def __getstate__(self):
+        if self.paths is None:
+            return self.__dict__.copy()
+        return {"paths": self.paths}
+
+    def __setstate__(self, state):
+        if "words" not in state:
+            state = self.load(state["paths"]).__dict__
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return str([str(self.get_object(i)) for i in range(0, len(self))])
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_object(self, index):
+        if not 0 <= index < len(self.ids):
+            return None
+        return self.words[self.ranks[index]].decode("utf-8")
+
+    def contains(self, object):
+        return self.index_of(object) != -1
+
+    def index_of(self, object):
+        return int(self.index_of_many([object])[0])
+
+    def index_of_many(self, objects):
+        if len(objects) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.array([o.encode("utf-8") for o in objects], dtype=np.bytes_)
+        pos = np.searchsorted(self.words, keys)
+        found = pos < len(self.words)
+        pos = np.minimum(pos, len(self.words) - 1)
+        found &= self.words[pos] == keys
+        return np.where(found, self.ids[pos], -1).astype(np.int64)
+
+
+def index_phrases(indexer, phrases, length, min_index=1):
+    """Index a list of token lists into (n, length) id and mask arrays.
+
+    Tokens past length are dropped and unknown tokens map to min_index.
+    """
+    input_ids = np.zeros((len(phrases), length), dtype=np.int64)
+    attn_masks = np.zeros((len(phrases), length), dtype=np.int64)
+    lengths = np.array([min(len(p), length) for p in phrases], dtype=np.int64)
+    tokens = [t for p in phrases for t in p[:length]]
+    if len(tokens) > 0:
+        rows = np.repeat(np.arange(len(phrases)), lengths)
+        cols = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        input_ids[rows, cols] = np.maximum(indexer.index_of_many(tokens), min_index)
+        attn_masks[rows, cols] = 1
+    return input_ids, attn_masks
+
+
+def glove_paths(embeddings_file):
+    prefix = os.path.splitext(embeddings_file)[0]
+    return prefix + ".vocab.txt", prefix + ".vectors.npy"
+
+
+def indexer_paths(embeddings_file):
+    prefix = os.path.splitext(embeddings_file)[0]
+    return tuple(
+        prefix + suffix
+        for suffix in (".index_words.npy", ".index_ids.npy", ".index_ranks.npy")
+    )
+
+
+def convert_glove(embeddings_file):
+    """Write the text GloVe file as a vocab file and a float32 .npy matrix.
+
+    Rows 0 and 1 are the zero vectors of PAD and UNK, as in load_vocabulary.
+    """
+    vocab_path, vectors_path = glove_paths(embeddings_file)
+    with open(embeddings_file, encoding="utf-8") as f:
+        n_words = 0
+        for line in f:
+            if line.strip() != "":
+                if n_words == 0:
+                    dim = len(line.split()) - 1
+                n_words += 1
+
+    pid = os.getpid()
+    tmp_vectors_path = "%s.%d.tmp" % (vectors_path, pid)
+    tmp_vocab_path = "%s.%d.tmp" % (vocab_path, pid)
+    vectors = np.lib.format.open_memmap(
+        tmp_vectors_path, mode="w+", dtype=np.float32, shape=(n_words + 2, dim)
+    )
+    vectors[:2] = 0
+    with open(embeddings_file, encoding="utf-8") as f, open(
+        tmp_vocab_path, "w", encoding="utf-8"
+    ) as vocab:
+        vocab.write("PAD\nUNK\n")
+        row = 2
+        for line in f:
+            if line.strip() != "":
+                space_idx = line.find(" ")
+                vocab.write(line[:space_idx] + "\n")
+                vectors[row] = np.array(line[space_idx + 1 :].split(), dtype=np.float32)
+                row += 1
+    vectors.flush()
+    del vectors
+    os.replace(tmp_vectors_path, vectors_path)
+    os.replace(tmp_vocab_path, vocab_path)
+    return vocab_path, vectors_path
+
+
+def load_vocabulary(embeddings_file: str, indexer_only=False) -> WordEmbeddings:
+    vocab_path, vectors_path = glove_paths(embeddings_file)
+    if not (os.path.exists(vocab_path) and os.path.exists(vectors_path)):
+        vocab_path, vectors_path = convert_glove(embeddings_file)
+
+    index_paths = indexer_paths(embeddings_file)
+    if not all(os.path.exists(path) for path in index_paths):
+        with open(vocab_path, encoding="utf-8") as f:
+            words = f.read().split("\n")[:-1]
+        CompactWordIndexer.from_objects(words).save(index_paths)
+    word_indexer = CompactWordIndexer.load(index_paths)
+
+    if indexer_only:
+        return WordEmbeddings(word_indexer)
+    return WordEmbeddings(word_indexer, vectors_path=vectors_path)
+
+class ImageSizeTable(object):
+    def __init__(self, image_ids, sizes):
+        order = np.argsort(image_ids)
+        self.image_ids = np.asarray(image_ids, dtype=np.int64)[order]
+        self.sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)[order]
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get(self, image_id):
+        image_id = int(image_id)
+        pos = np.searchsorted(self.image_ids, image_id)
+        if pos >= len(self.image_ids) or self.image_ids[pos] != image_id:
+            raise KeyError(image_id)
+        width, height = self.sizes[pos]
+        return int(width), int(height)
+
 
-    word_indexer.add_and_get_index("PAD")
+def build_image_sizes(image_dir):
+    from PIL import Image
 
-    word_indexer.add_and_get_index("UNK")
-    for line in f:
-        if line.strip() != "":
-            space_idx = line.find(" ")
-            word = line[:space_idx]
-            numbers = line[space_idx + 1 :]
-            float_numbers = [float(number_str) for number_str in numbers.split()]
-            vector = np.array(float_numbers)
-            word_indexer.add_and_get_index(word)
+    image_ids = []
+    sizes = []
+    for f in sorted(os.listdir(image_dir)):
+        if not f.endswith(".jpg"):
+            continue
+        # PIL only parses the header here, the pixel data is never decoded
+        with Image.open(os.path.join(image_dir, f)) as image:
+            sizes.append(image.size)
+        image_ids.append(int(f.split(".")[0].split("_")[-1]))
+    return ImageSizeTable(image_ids, sizes)
 
-            if len(vectors) == 0:
-                vectors.append(np.zeros(vector.shape[0]))
-                vectors.append(np.zeros(vector.shape[0]))
-            vectors.append(vector)
-    f.close()
 
+def load_image_sizes(image_dir, table_path):
+    if os.path.exists(table_path):
+        table = np.load(table_path)
+        return ImageSizeTable(table["image_ids"], table["sizes"])
+
+    image_sizes = build_image_sizes(image_dir)
+    tmp_path = "%s.%d.tmp" % (table_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.savez(f, image_ids=image_sizes.image_ids, sizes=image_sizes.sizes)
+    os.replace(tmp_path, table_path)
+    return image_sizes
+
+
+def build_first_index(keys):
+    index = {}
+    for i, key in enumerate(keys):
+        index.setdefault(key, i)
+    return index
 
-    return WordEmbeddings(word_indexer, np.array(vectors))
 
 def find_sublist_single(arr, sub):
     sublen = len(sub)
@@ -171,23 +377,17 @@ def find_sublist_n_occ(arr, sub):
     return -1, -1
 
 
-def get_gt_coref_matrix(phrases, clusters):
-    gt_coref_matrix = np.zeros((len(phrases), len(phrases)))
-    for i in range(len(clusters)):
-        for j in range(len(clusters)):
-            if clusters[i] == clusters[j]:
-                gt_coref_matrix[i][j] = 1.0
-
-    return gt_coref_matrix
-
-def get_flickr_gt_coref_matrix(entities_id, phrases):
-
-    gt_coref_matrix = np.zeros((len(phrases), len(phrases)))
-    for i in range(len(entities_id)):
-        for j in range(len(entities_id)):
-            if entities_id[i] == entities_id[j]:
-                gt_coref_matrix[i][j] = 1.0
-
-    return gt_coref_matrix
+def coref_cluster_ids(clusters, length=None):
+    """int32 code of each phrase's cluster, -1 for phrases without one.
 
+    Equal clusters get equal codes; the output has length entries (default
+    len(clusters)) so it can be laid out against the phrase list.
+    """
+    n = len(clusters) if length is None else length
+    ids = np.full(n, -1, dtype=np.int32)
+    if len(clusters) > 0:
+        _, codes = np.unique(np.asarray(clusters), return_inverse=True)
+        k = min(n, len(codes))
+        ids[:k] = codes.reshape(-1)[:k]
+    return ids
 
@@ -0,0 +1,76 @@
+from data import batching
+
+
+class DualStreamLoader(object):
+    """Pair every labeled batch with ssl_ratio batches of the SSL loader.
+
+    Iterating yields (labeled_batch, [ssl_batch, ...]) tuples. The SSL stream
+    runs independently of the labeled one: its iterator is kept across
+    labeled epochs and only restarted when it is exhausted, advancing its own
+    sampler epoch, so persistent DataLoader workers and a PrefetchLoader in
+    front of it keep running instead of being torn down every epoch.
+
+    mode="epoch" yields one pass over the labeled loader per iteration,
+    mode="infinite" cycles it until the caller stops.
+    """
+
+    def __init__(self, labeled, ssl=None, ssl_ratio=1, mode="epoch"):
+        if mode not in ("epoch", "infinite"):
+            raise ValueError("mode must be 'epoch' or 'infinite', got %r" % mode)
+        if ssl_ratio < 0:
+            raise ValueError("ssl_ratio must be >= 0, got %d" % ssl_ratio)
+        self.labeled = labeled
+        self.ssl = ssl
+        self.ssl_ratio = ssl_ratio if ssl is not None else 0
+        self.mode = mode
+        self.epoch = 0
+        self.ssl_epoch = 0
+        self._ssl_iter = None
+
+    def __len__(self):
+        if self.mode == "infinite":
+            raise TypeError("an infinite DualStreamLoader has no length")
+        return len(self.labeled)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _start_ssl(self):
+        batching.set_epoch(self.ssl, self.ssl_epoch)
+        self._ssl_iter = iter(self.ssl)
+
+    def _next_ssl(self):
+        if self._ssl_iter is None:
+            self._start_ssl()
+        try:
+            return next(self._ssl_iter)
+        except StopIteration:
+            self.ssl_epoch += 1
+            self._start_ssl()
+        try:
+            return next(self._ssl_iter)
+        except StopIteration:
+            raise RuntimeError("the SSL loader yields no batches")
+
+    def _labeled_epoch(self):
+        batching.set_epoch(self.labeled, self.epoch)
+        for batch in self.labeled:
+            yield batch, [self._next_ssl() for _ in range(self.ssl_ratio)]
+        self.epoch += 1
+
+    def __iter__(self):
+        if self.mode == "epoch":
+            return self._labeled_epoch()
+        return self._forever()
+
+    def _forever(self):
+        while True:
+            for pair in self._labeled_epoch():
+                yield pair
+
+    def close(self):
+        """Stop the SSL stream, e.g. a PrefetchLoader's copy thread."""
+        close = getattr(self._ssl_iter, "close", None)
+        if close is not None:
+            close()
+        self._ssl_iter = None
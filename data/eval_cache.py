@@ -0,0 +1,122 @@
+import functools
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+from data import batching
+
+
+def _place(value, device=None, pin_memory=False):
+    if not torch.is_tensor(value):
+        return value
+    if device is not None:
+        return value.to(device)
+    if pin_memory and torch.cuda.is_available():
+        return value.pin_memory()
+    return value
+
+
+class CachedEvalSet(object):
+    """Evaluation batches collated once and kept on device or in pinned memory.
+
+    The loader it is built from must collate with batching.collate_dynamic:
+    batches are stored in the compact dtypes of batching.SAMPLE_FIELDS and
+    finished with batching.finish_eval as they are iterated, so it can be
+    passed to evaluate() in place of a collate_eval DataLoader without
+    re-running feature extraction.
+    """
+
+    def __init__(self, batches):
+        self.batches = batches
+
+    @classmethod
+    def from_loader(cls, loader, device=None, pin_memory=False):
+        batches = [
+            [_place(value, device, pin_memory) for value in batch] for batch in loader
+        ]
+        return cls(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batching.finish_eval(batch)
+
+    def subset(self, num_batches, seed=0):
+        if num_batches <= 0 or num_batches >= len(self.batches):
+            return self
+        rng = np.random.RandomState(seed)
+        indices = np.sort(rng.choice(len(self.batches), num_batches, replace=False))
+        return CachedEvalSet([self.batches[i] for i in indices])
+
+
+class SubsetSampler(Sampler):
+    """num_samples of indices drawn at random, redrawn by set_seed."""
+
+    def __init__(self, indices, num_samples, seed=0):
+        self.indices = list(indices)
+        self.num_samples = min(num_samples, len(self.indices))
+        self.seed = seed
+
+    def set_seed(self, seed):
+        self.seed = seed
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed)
+        chosen = np.sort(
+            rng.choice(len(self.indices), self.num_samples, replace=False)
+        )
+        return iter([self.indices[i] for i in chosen])
+
+    def __len__(self):
+        return self.num_samples
+
+
+class SampledLoader(object):
+    """num_batches batches of randomly sampled test examples.
+
+    Samples are drawn from the indices the wrapped DataLoader's sampler
+    yields (this rank's shard when it is distributed). A single DataLoader
+    with persistent workers is built over them and sample(seed) redraws the
+    subset, so repeated step evaluations do not restart the workers.
+    """
+
+    def __init__(self, loader, num_batches):
+        self.sampler = SubsetSampler(
+            loader.sampler, num_batches * loader.batch_size
+        )
+        self.loader = DataLoader(
+            loader.dataset,
+            batch_size=loader.batch_size,
+            sampler=self.sampler,
+            num_workers=loader.num_workers,
+            collate_fn=loader.collate_fn,
+            pin_memory=loader.pin_memory,
+            drop_last=loader.drop_last,
+            persistent_workers=loader.num_workers > 0,
+        )
+
+    def sample(self, seed):
+        self.sampler.set_seed(seed)
+        return self
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        return iter(self.loader)
+
+
+def eval_subset(loader, num_batches):
+    """Function of a seed returning num_batches random batches of loader.
+
+    Build it once per training run: for a DataLoader it holds a
+    SampledLoader whose persistent workers serve every step evaluation.
+    """
+    if num_batches <= 0:
+        return lambda seed: loader
+    if isinstance(loader, CachedEvalSet):
+        return functools.partial(loader.subset, num_batches)
+    return SampledLoader(loader, num_batches).sample
@@ -0,0 +1,73 @@
+import os
+
+import h5py
+import numpy as np
+
+_open_stores = {}
+
+
+def store_paths(h5_path):
+    prefix = os.path.splitext(h5_path)[0]
+    return prefix + ".features.npy", prefix + ".pos_bboxes.npy"
+
+
+def convert_hdf5(h5_path, chunk_rows=65536):
+    features_path, pos_boxes_path = store_paths(h5_path)
+    pid = os.getpid()
+    with h5py.File(h5_path, "r") as hf:
+        features = hf["features"]
+        tmp_path = "%s.%d.tmp" % (features_path, pid)
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=features.dtype, shape=features.shape
+        )
+        for start in range(0, features.shape[0], chunk_rows):
+            out[start : start + chunk_rows] = features[start : start + chunk_rows]
+        out.flush()
+        del out
+        os.replace(tmp_path, features_path)
+
+        pos_boxes = np.array(hf.get("pos_bboxes"), dtype=np.int64)
+    tmp_path = "%s.%d.tmp" % (pos_boxes_path, pid)
+    with open(tmp_path, "wb") as f:
+        np.save(f, pos_boxes)
+    os.replace(tmp_path, pos_boxes_path)
+    return features_path, pos_boxes_path
+
+
+class FeatureStore(object):
+    def __init__(self, features_path, pos_boxes_path):
+        self.features_path = features_path
+        self.pos_boxes_path = pos_boxes_path
+        self._open()
+
+    def _open(self):
+        self.features = np.load(self.features_path, mmap_mode="r")
+        self.pos_boxes = np.load(self.pos_boxes_path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.pos_boxes)
+
+    def get_features(self, pos):
+        return np.array(self.features[pos[0] : pos[1]], dtype=np.float32)
+
+    # pickle by path so spawned DataLoader workers re-map the files instead of
+    # receiving a copy of the arrays
+    def __getstate__(self):
+        return {
+            "features_path": self.features_path,
+            "pos_boxes_path": self.pos_boxes_path,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+def open_feature_store(h5_path):
+    key = os.path.abspath(h5_path)
+    if key not in _open_stores:
+        features_path, pos_boxes_path = store_paths(h5_path)
+        if not (os.path.exists(features_path) and os.path.exists(pos_boxes_path)):
+            features_path, pos_boxes_path = convert_hdf5(h5_path)
+        _open_stores[key] = FeatureStore(features_path, pos_boxes_path)
+    return _open_stores[key]
@@ -13,12 +13,15 @@ import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
 import re
-from PIL import Image
 from data import data_utils
+from data import feature_store
+from data import batching
+from data import sense2vec_features
+from data import tokenization
+from data import span_alignment
 
 from data import patch_sentence_similarity_clip
 from utils import utils
-from transformers import BertTokenizer
 
 import torch
 import torchvision
@@ -28,7 +31,11 @@ import torchvision.models as models
 NoneType = type(None)
 bert_version = "bert-base-uncased"
 
-nlp = spacy.load("en_core_web_sm")
+# only the tagger, parser and attribute ruler are needed for noun chunks and tags
+nlp = spacy.load("en_core_web_sm", disable=["ner", "lemmatizer"])
+
+TEXT_CACHE_VERSION = 2
+CAPTION_LABEL_START_LENGTH = 43620
 
 stop_words = [
     "we",
@@ -87,6 +94,11 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
             ssl=False,
             sentence_patch_sim=False,
             eval_grounding=False,
+            cache_dir=None,
+            pad_to_max=True,
+            return_phrases=True,
+            sense2vec_path=None,
+            s2v_float16=False,
     ):
         self.split = split
         self.ssl = ssl
@@ -97,6 +109,12 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
         self.dataroot = dataroot
         self.sentence_patch_sim = sentence_patch_sim
         self.eval_grounding = eval_grounding
+        self.cache_dir = cache_dir
+        self.pad_to_max = pad_to_max
+        self.return_phrases = return_phrases
+        self.sense2vec = sense2vec_features.Sense2VecFeatures.load(
+            sense2vec_path, dtype=np.float16 if s2v_float16 else np.float32
+        )
         self.encoding_type = "bert"
         self.coco_data = False
         self.imgid2idx = pickle.load(
@@ -188,9 +206,7 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
             "%s_features_compress.hdf5" % split,
         )
 
-        with h5py.File(h5_path, "r") as hf:
-            self.features = np.array(hf.get("features"))
-            self.pos_boxes = np.array(hf.get("pos_bboxes"))
+        self.feature_store = feature_store.open_feature_store(h5_path)
 
         self.obj_detection_dict = os.path.join(
             dataroot,
@@ -205,9 +221,7 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
             "%s_features_compress.hdf5" % "val",
         )
 
-        with h5py.File(val_h5_path, "r") as hf:
-            self.val_features = np.array(hf.get("features"))
-            self.val_pos_boxes = np.array(hf.get("pos_bboxes"))
+        self.val_feature_store = feature_store.open_feature_store(val_h5_path)
 
         self.val_obj_detection_dict = os.path.join(
             dataroot,
@@ -222,10 +236,14 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
         )["images"]
         wordembedding = word_embedding
         self.indexer = wordembedding.word_indexer
-        self.tokenizer = BertTokenizer.from_pretrained(bert_version)
+        self.tokenizer = tokenization.load_tokenizer(bert_version)
 
         with h5py.File(os.path.join(dataroot, "flk30k_LN_label.h5"), "r") as hf:
             self.caption_label_start = np.array(hf.get("label_start_ix"))
+            padding_length = CAPTION_LABEL_START_LENGTH - len(self.caption_label_start)
+            self.caption_label_start = np.pad(
+                self.caption_label_start, (0, padding_length), mode="constant"
+            )
             self.caption_label_end = np.array(hf.get("label_end_ix"))
             self.caption_labels = np.array(hf.get("labels"))
 
@@ -250,53 +268,43 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
             open(self.localized_narratives_annotated_testval_file, "rb")
         )
 
-    def __getitem__(self, index):
-        image_id = self.image_ids[index]
-        image_dir = os.path.join(self.dataroot, "flickr30k-images")
+        self.image_sizes = data_utils.load_image_sizes(
+            os.path.join(dataroot, "flickr30k-images"),
+            os.path.join(dataroot, "flickr30k_image_sizes.npz"),
+        )
+        self.train_image_id_set = set(self.train_image_ids)
+        self.caption_index = data_utils.build_first_index(
+            image["id"] for image in self.imagesid_from_captiondata
+        )
+        self.annotation_index = data_utils.build_first_index(
+            annotation["image"] for annotation in self.localized_narratives_testval_data
+        )
 
+    def _is_train_image(self, image_id):
+        return int(image_id) in self.train_image_id_set
 
-        if int(image_id) in self.train_image_ids or self.split == "test":
+    def _get_image_features(self, image_id):
+        if self._is_train_image(image_id) or self.split == "test":
 
             idx = self.imgid2idx[int(image_id)]
+            pos_boxes = self.feature_store.pos_boxes
 
-            if idx < len(self.pos_boxes):
-                pos = self.pos_boxes[idx]
+            if idx < len(pos_boxes):
+                pos = pos_boxes[idx]
             else:
-                pos = self.pos_boxes[len(self.pos_boxes) - 1]
-            image = Image.open(
-                os.path.join(self.dataroot, "flickr30k-images", str(image_id) + ".jpg")
-            )
-            im_width = image.size[0]
-            im_height = image.size[1]
+                pos = pos_boxes[len(pos_boxes) - 1]
+            im_width, im_height = self.image_sizes.get(image_id)
             hw_array = [im_width, im_height, im_width, im_height]
-            feature = torch.from_numpy(self.features[pos[0]: pos[1]]).float()
-
-            if feature.size(0) < self.max_detected_boxes:
-                pad = nn.ZeroPad2d((0, 0, 0, self.max_detected_boxes - feature.size(0)))
-                feature = pad(feature)
-            else:
-                feature = feature[: self.max_detected_boxes]
+            feature = torch.from_numpy(
+                self.feature_store.get_features(pos)[: self.max_detected_boxes]
+            )
 
             image_id = str(image_id)
-            bboxes = np.array(self.obj_detection_dict[image_id]["bboxes"])
-            bboxes = bboxes.tolist()
+            bboxes = self.obj_detection_dict[image_id]["bboxes"][: self.max_detected_boxes]
             labels = self.obj_detection_dict[image_id]["classes"]
-            attrs = (
-                self.obj_detection_dict[image_id]["attrs"]
-                if "attrs" in self.obj_detection_dict[image_id].keys()
-                else []
-            )
-
-            padbox = [0, 0, 0, 0]
 
-            while len(bboxes) < self.max_detected_boxes:
-                bboxes.append(padbox)
-            bboxes = bboxes[: self.max_detected_boxes]
-            bboxes = torch.tensor(bboxes)
+            bboxes = torch.tensor(bboxes).reshape(-1, 4)
             area = (bboxes[..., 3] - bboxes[..., 1]) * (bboxes[..., 2] - bboxes[..., 0])
-
-            height = bboxes[..., 3] - bboxes[..., 1]
-            width = bboxes[..., 2] - bboxes[..., 0]
             bboxes = torch.cat(
                 (
                     bboxes,
@@ -307,39 +315,22 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
 
         else:
             idx = self.val_imgid2idx[int(image_id)]
-            image = Image.open(
-                os.path.join(self.dataroot, "flickr30k-images", str(image_id) + ".jpg")
-            )
-            im_width = image.size[0]
-            im_height = image.size[1]
+            im_width, im_height = self.image_sizes.get(image_id)
             hw_array = [im_width, im_height, im_width, im_height]
 
-            if idx < len(self.val_pos_boxes):
-                pos = self.val_pos_boxes[idx]
+            if idx < len(self.val_feature_store):
+                pos = self.val_feature_store.pos_boxes[idx]
             else:
-                pos = self.pos_boxes[idx - 1000]
-            feature = torch.from_numpy(self.val_features[pos[0]: pos[1]]).float()
-            if feature.size(0) < self.max_detected_boxes:
-                pad = nn.ZeroPad2d((0, 0, 0, self.max_detected_boxes - feature.size(0)))
-                feature = pad(feature)
-            else:
-                feature = feature[: self.max_detected_boxes]
+                pos = self.feature_store.pos_boxes[idx - 1000]
+            feature = torch.from_numpy(
+                self.val_feature_store.get_features(pos)[: self.max_detected_boxes]
+            )
 
             image_id = str(image_id)
-            bboxes = np.array(self.val_obj_detection_dict[image_id]["bboxes"])
-            scaled_bboxes = bboxes / hw_array
-            scaled_bboxes = scaled_bboxes.tolist()
-            bboxes = bboxes.tolist()
+            bboxes = self.val_obj_detection_dict[image_id]["bboxes"][: self.max_detected_boxes]
             labels = self.val_obj_detection_dict[image_id]["classes"]
-            padbox = [0, 0, 0, 0]
-
-            while len(bboxes) < self.max_detected_boxes:
-                bboxes.append(padbox)
-            bboxes = bboxes[: self.max_detected_boxes]
-            bboxes = torch.tensor(bboxes)
+            bboxes = torch.tensor(bboxes).reshape(-1, 4)
             area = (bboxes[..., 3] - bboxes[..., 1]) * (bboxes[..., 2] - bboxes[..., 0])
-            height = bboxes[..., 3] - bboxes[..., 1]
-            width = bboxes[..., 2] - bboxes[..., 0]
             bboxes = torch.cat(
                 (
                     bboxes,
@@ -349,477 +340,534 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
             )
             bboxes = bboxes / bboxes.sum()
 
-        num_objects = min(len(labels), self.max_detected_boxes)
+        return feature, bboxes, labels
 
+    def _encode_object_labels(self, labels):
+        num_objects = min(len(labels), self.max_detected_boxes)
         if self.encoding_type == "glove":
-            object_label_input_ids = [0] * self.max_detected_boxes
-            object_label_attn_mask = [0] * self.max_detected_boxes
-            object_label_input_ids[:num_objects] = [
-                max(self.indexer.index_of(re.split(" ,", w)[-1]), 1) for w in labels
-            ]
-
-            object_label_input_ids = object_label_input_ids[: self.max_detected_boxes]
-            object_label_attn_mask = object_label_attn_mask[: self.max_detected_boxes]
-            object_label_input_ids = torch.tensor(object_label_input_ids)
-            object_label_attn_mask = torch.tensor(object_label_attn_mask)
+            object_label_input_ids = np.maximum(
+                self.indexer.index_of_many(
+                    [re.split(" ,", w)[-1] for w in labels[:num_objects]]
+                ),
+                1,
+            )
+            object_label_attn_mask = [0] * num_objects
         else:
+            object_label_input_ids, object_label_attn_mask = tokenization.encode_labels(
+                self.tokenizer, labels[:num_objects], max_length=16
+            )
+        return (
+            np.array(object_label_input_ids, dtype=np.int64),
+            np.array(object_label_attn_mask, dtype=np.int64),
+        )
 
-            object_label_input_ids = []
-            object_label_attn_mask = []
-            for l in labels:
-                obj_encoded = self.tokenizer.encode_plus(
-                    text=[l],
-                    add_special_tokens=False,
-                    max_length=16,
-                    pad_to_max_length=True,
-                    return_attention_mask=True,
-                    return_tensors="pt",
-                )
+    def _tokenize_phrases(self, phrases):
+        unique_phrases = list(dict.fromkeys(phrases))
+        phrase_tokens = tokenization.tokenize_batch(self.tokenizer, unique_phrases)
+        return dict(zip(unique_phrases, phrase_tokens))
+
+    def _encode_phrases(self, phrases, phrase_tokens=None):
+        if phrase_tokens is None:
+            phrase_tokens = self._tokenize_phrases(phrases)
+        return data_utils.index_phrases(
+            self.indexer,
+            [phrase_tokens[phrase] for phrase in phrases],
+            self.max_query_length,
+        )
 
+    def _sense2vec_feats(self, doc):
+        return self.sense2vec.doc_features(doc)
+
+    def _scale_target_bbox(self, bbox, img_width, img_height):
+        x = (bbox[0] * img_width) / 100.0
+        y = (bbox[1] * img_height) / 100.0
+        w = (bbox[2] * img_width) / 100.0
+        h = (bbox[3] * img_height) / 100.0
+        return [int(x), int(y), int(x + w), int(y + h)]
+
+    def _sorted_annotation(self, annotation):
+        query_start_char_list = [
+            start_end[0] for start_end in annotation["query_start_end"]
+        ]
+        sorted_query_char_idx = sorted(
+            range(len(query_start_char_list)),
+            key=lambda k: query_start_char_list[k],
+        )
+        entities = [annotation["query"][x] for x in sorted_query_char_idx]
+        t_bboxes = [annotation["target_bboxes"][x] for x in sorted_query_char_idx]
+        clusters = [annotation["cluster"][x] for x in sorted_query_char_idx]
+        query_start_end = [
+            annotation["query_start_end"][x] for x in sorted_query_char_idx
+        ]
+        return entities, t_bboxes, clusters, query_start_end
+
+    def _get_annotation(self, image_id):
+        return self.localized_narratives_testval_data[
+            self.annotation_index[str(image_id)]
+        ]
+
+    def _train_caption(self, image_id):
+        caption_idx = self.caption_index[int(image_id)]
+        label_start_ix = self.caption_label_start[caption_idx]
+        caption_seq_idx = self.caption_labels[label_start_ix - 1]
+        caption_seq = [
+            "".join(self.vocab[str(caption_seq_idx[i])])
+            for i in range(len(caption_seq_idx))
+            if caption_seq_idx[i] > 0
+        ]
+        return " ".join(caption_seq)
+
+    def _texts_to_parse(self, image_id):
+        """Caption and phrase strings that build_text_features runs spaCy on."""
+        if self.split == "train" and self._is_train_image(image_id):
+            return str(self._train_caption(image_id)), []
+        annotation = self._get_annotation(image_id)
+        if self.split == "train":
+            return str(annotation["captions"]), []
+        entities = self._sorted_annotation(annotation)[0][: self.max_queries]
+        return str(annotation["captions"]), entities
 
-                object_label_input_ids.append(
-                    (obj_encoded["input_ids"]).numpy().tolist()
-                )
-                object_label_attn_mask.append(
-                    (obj_encoded["attention_mask"]).numpy().tolist()
-                )
+    def _phrase_token_spans(
+        self, phrases, start_end, tokenized_caption_seq, offsets, phrase_tokens
+    ):
+        """Inclusive token span of each phrase in the tokenized caption."""
+        if offsets is not None:
+            return span_alignment.char_to_token_spans(
+                offsets, span_alignment.phrase_char_spans(start_end, phrases)
+            ).tolist()
+        # the Python tokenizer gives no offsets, search the token lists instead
+        token_spans = []
+        char_indx = -1
+        for phrase in phrases:
+            start, end, char_indx = data_utils.find_sublist(
+                tokenized_caption_seq, phrase_tokens[phrase], char_indx + 1
+            )
+            token_spans.append([start, end])
+        return token_spans
+
+    def _build_train_caption_features(self, image_id, docs=None):
+        caption_seq = self._train_caption(image_id)
+
+        phrase_queries = []
+        phrase_queries_start_end_idx = []
+        pos_tags = []
+        doc = docs[0] if docs is not None else nlp(str(caption_seq))
+        for _, entity in enumerate(doc.noun_chunks):
+            if entity.text not in stop_words:
+                phrase_queries.append(entity.text)
+                phrase_queries_start_end_idx.append([entity.start, entity.end])
+                pos_tags.append(entity.root.tag_)
+        phrase_queries_input_ids, phrase_queries_attention_mask = self._encode_phrases(
+            phrase_queries
+        )
 
-            padbox = [0] * 16
+        return {
+            "caption": caption_seq,
+            "phrase_queries": phrase_queries,
+            "phrase_start_end": phrase_queries_start_end_idx,
+            "phrase_input_ids": phrase_queries_input_ids,
+            "phrase_attention_mask": phrase_queries_attention_mask,
+            "pos_tags": pos_tags,
+            "sense2vec_feats": self._sense2vec_feats(doc),
+            "target_bboxes": [[0.0, 0.0, 0.0, 0.0]],
+            "coref_clusters": data_utils.coref_cluster_ids([], len(phrase_queries)),
+            "max_assignments": None,
+        }
+
+    def _build_annotated_train_features(self, image_id, docs=None):
+        annotation = self._get_annotation(image_id)
+        caption_seq = annotation["captions"]
+        entities, t_bboxes, clusters, char_start_end = self._sorted_annotation(
+            annotation
+        )
 
-            while len(object_label_input_ids) < self.max_detected_boxes:
-                object_label_input_ids.append([padbox])
-                object_label_attn_mask.append([padbox])
-            object_label_input_ids = object_label_input_ids[: self.max_detected_boxes]
-            object_label_input_ids = torch.tensor(object_label_input_ids)
-            object_label_attn_mask = object_label_attn_mask[: self.max_detected_boxes]
-            object_label_attn_mask = torch.tensor(object_label_attn_mask)
+        target_bboxes = []
+        doc = docs[0] if docs is not None else nlp(str(caption_seq))
+        caption_input_ids, tokenized_caption_seq, offsets = tokenization.encode_caption(
+            self.tokenizer, caption_seq, self.max_caption_length
+        )
+        entity_tokens = self._tokenize_phrases(entities)
+        kept = [i for i, entity in enumerate(entities) if entity not in stop_words]
+        phrase_queries = [entities[i] for i in kept]
+        phrase_queries_start_end_idx = self._phrase_token_spans(
+            phrase_queries,
+            [char_start_end[i] for i in kept],
+            tokenized_caption_seq,
+            offsets,
+            entity_tokens,
+        )
+        phrase_queries_input_ids, phrase_queries_attention_mask = self._encode_phrases(
+            phrase_queries, entity_tokens
+        )
 
-        if self.split == "train":
-            if int(image_id) in self.train_image_ids:
-
-                caption_idx = [
-                    idx
-                    for idx in range(len(self.imagesid_from_captiondata))
-                    if self.imagesid_from_captiondata[idx]["id"] == int(image_id)
-                ][0]
-                target_length = 43620
-                padding_length = target_length - len(self.caption_label_start)
-                self.caption_label_start = np.pad(self.caption_label_start, (0, padding_length), mode='constant')
-                label_start_ix = self.caption_label_start[caption_idx]
-                caption_seq_idx = self.caption_labels[
-                    label_start_ix - 1
-                    ]
-                caption_seq = [
-                    "".join(self.vocab[str(caption_seq_idx[i])])
-                    for i in range(len(caption_seq_idx))
-                    if caption_seq_idx[i] > 0
-                ]
-                caption_seq = " ".join(caption_seq)
-                phrase_queries = []
-                phrase_queries_start_end_idx = []
-                mouse_trace_for_phrases = []
-                phrase_queries_input_ids = []
-                phrase_queries_attention_mask = []
-                start_end_phrases = []
-                pos_tags = []
-                rel_phrases = []
-                target_bboxes = []
-                doc = nlp(str(caption_seq))
-                noun_phrases = doc.noun_chunks
-                sense2vec_feats = []
-                char_indx = -1
-                tokenized_caption_seq = self.tokenizer.tokenize(caption_seq)
-
-                for k in range(len(doc)):
-                    try:
-                        sense2vec_feats.append(torch.tensor(doc[k]._.s2v_vec))
-                    except:
-                        sense2vec_feats.append(torch.tensor([0.0] * 128))
-
-                for _, entity in enumerate(noun_phrases):
-                    if entity.text not in stop_words:
-                        phrase = entity.text
-                        phrase_queries.append(phrase)
-                        phrase_queries_start_end_idx.append([entity.start, entity.end])
-                        phrase_input_ids = []
-                        phrase_attention_mask = []
-                        s = self.tokenizer.tokenize(phrase)
-                        lis = [0] * self.max_query_length
-                        attn_masks = [0] * self.max_query_length
-                        for i in range(min(len(s), self.max_query_length)):
-                            lis[i] = max(self.indexer.index_of(s[i]), 1)
-                            attn_masks[i] = 1
-                        phrase_input_ids.append(lis)
-                        phrase_attention_mask.append(attn_masks)
-                        phrase_queries_input_ids.append(torch.tensor(phrase_input_ids))
-                        phrase_queries_attention_mask.append(
-                            torch.tensor(phrase_attention_mask)
-                        )
-
-                gt_coref_matrix = np.zeros((len(phrase_queries), len(phrase_queries)))
-
-                target_bboxes.append([[0.0, 0.0, 0.0, 0.0]])
-                for _, entity in enumerate(doc.noun_chunks):
-                    if entity.text not in stop_words:
-                        rel_phrases.append(entity.text)
-                        pos_tags.append(entity.root.tag_)
-                        start_end_phrases.append([entity.start, entity.end])
-                rule_coref_matrix = np.zeros((len(phrase_queries), len(phrase_queries)))
+        for i, entity in enumerate(entities):
+            if len(t_bboxes[i]) > 0:
+                target_bboxes.append(
+                    self._scale_target_bbox(
+                        t_bboxes[i][0], annotation["img_width"], annotation["img_height"]
+                    )
+                )
+            else:
+                target_bboxes.append([0.0, 0.0, 0.0, 0.0])
+
+        return {
+            "caption": caption_seq,
+            "phrase_queries": phrase_queries,
+            "phrase_start_end": phrase_queries_start_end_idx,
+            "phrase_input_ids": phrase_queries_input_ids,
+            "phrase_attention_mask": phrase_queries_attention_mask,
+            "pos_tags": [],
+            "sense2vec_feats": self._sense2vec_feats(doc),
+            "target_bboxes": target_bboxes,
+            "coref_clusters": data_utils.coref_cluster_ids(clusters, len(entities)),
+            "max_assignments": None,
+            "caption_input_ids": caption_input_ids,
+        }
+
+    def _build_eval_features(self, image_id, docs=None):
+        annotation = self._get_annotation(image_id)
+        caption_seq = annotation["captions"]
+        entities, t_bboxes, clusters, sort_query_start_end_char_index = (
+            self._sorted_annotation(annotation)
+        )
+        caption_input_ids, tokenized_caption_seq, offsets = tokenization.encode_caption(
+            self.tokenizer, caption_seq, self.max_caption_length
+        )
+        phrase_queries = []
+        target_bboxes = []
+        phrase_queries_start_end_idx = []
+        max_assignments = []
+        pos_tags = []
+
+        doc = docs[0] if docs is not None else nlp(str(caption_seq))
+        entities = entities[: self.max_queries]
+        for k in clusters:
+            max_assignments.append(sum(1 for c in clusters if c == k))
+
+        entity_tokens = self._tokenize_phrases(entities)
+        if len(entities) > 0:
+            query_start_end = self._phrase_token_spans(
+                entities,
+                sort_query_start_end_char_index[: len(entities)],
+                tokenized_caption_seq,
+                offsets,
+                entity_tokens,
+            )
+            for i, entity in enumerate(entities):
+                if len(t_bboxes[i]) > 0:
+                    img_height = annotation["img_height"]
+                    img_width = annotation["img_width"]
+                    phrase_queries.append(entity)
+                    phrase_queries_start_end_idx.append(query_start_end[i])
+
+                for bdx in range(len(t_bboxes[i])):
+                    target_bboxes.append(
+                        self._scale_target_bbox(t_bboxes[i][bdx], img_width, img_height)
+                    )
 
+                if self.eval_grounding:
+                    if len(t_bboxes[i]) > 1:
+                        for _ in range(len(t_bboxes[i]) - 1):
+                            phrase_queries.append(entity)
+                            phrase_queries_start_end_idx.append(query_start_end[i])
+
+        phrase_queries_input_ids, phrase_queries_attention_mask = self._encode_phrases(
+            phrase_queries, entity_tokens
+        )
+        if docs is not None:
+            phrase_docs = docs[1]
+        else:
+            unique_queries = list(dict.fromkeys(phrase_queries))
+            phrase_docs = dict(zip(unique_queries, nlp.pipe(unique_queries)))
+        for entity in phrase_queries:
+            spacy_entity_np = list(phrase_docs[entity].noun_chunks)
+            if len(spacy_entity_np) > 0:
+                pos_tags.append(spacy_entity_np[-1].root.tag_)
             else:
-                phrase_queries = []
-                phrase_queries_start_end_idx = []
-                target_bboxes = []
-                phrase_queries_input_ids = []
-                phrase_queries_attention_mask = []
-                mouse_trace_for_phrases = []
-                phrase_file = [
-                    idx
-                    for idx in range(len(self.localized_narratives_testval_data))
-                    if self.localized_narratives_testval_data[idx]["image"]
-                       == str(image_id)
-                ]
-                caption_seq = self.localized_narratives_testval_data[phrase_file[0]][
-                    "captions"
-                ]
-                org_entities = self.localized_narratives_testval_data[phrase_file[0]][
-                    "query"
-                ]
-                org_clusters = self.localized_narratives_testval_data[phrase_file[0]][
-                    "cluster"
-                ]
-                org_t_bboxes = self.localized_narratives_testval_data[phrase_file[0]][
-                    "target_bboxes"
-                ]
-                query_start_end_char_index = self.localized_narratives_testval_data[
-                    phrase_file[0]
-                ][
-                    "query_start_end"
-                ]
-                query_start_char_list = []
-                for start_end in query_start_end_char_index:
-                    query_start_char_list.append(start_end[0])
-                sorted_query_char_idx = sorted(
-                    range(len(query_start_char_list)),
-                    key=lambda k: query_start_char_list[k],
-                )
-                entities = [org_entities[x] for x in sorted_query_char_idx]
-                t_bboxes = [org_t_bboxes[x] for x in sorted_query_char_idx]
-                clusters = [org_clusters[x] for x in sorted_query_char_idx]
-                char_indx = -1
-                sense2vec_feats = []
-                doc = nlp(str(caption_seq))
-                tokenized_caption_seq = self.tokenizer.tokenize(caption_seq)
-                for k in range(len(doc)):
-                    try:
-                        sense2vec_feats.append(torch.tensor(doc[k]._.s2v_vec))
-                    except:
-                        sense2vec_feats.append(torch.tensor([0.0] * 128))
-                for _, entity in enumerate(entities):
-                    if entity not in stop_words:
-                        phrase = entity
-                        start_idx, end_idx, char_indx = data_utils.find_sublist(
-                            tokenized_caption_seq,
-                            self.tokenizer.tokenize(phrase),
-                            char_indx + 1,
-                        )
-                        phrase_queries.append(phrase)
-                        phrase_queries_start_end_idx.append([start_idx, end_idx])
-                        phrase_input_ids = []
-                        phrase_attention_mask = []
-                        s = self.tokenizer.tokenize(phrase)
-                        lis = [0] * self.max_query_length
-                        attn_masks = [0] * self.max_query_length
-                        for i in range(min(len(s), self.max_query_length)):
-                            lis[i] = max(self.indexer.index_of(s[i]), 1)
-                            attn_masks[i] = 1
-                        phrase_input_ids.append(lis)
-                        phrase_attention_mask.append(attn_masks)
-                        phrase_queries_input_ids.append(torch.tensor(phrase_input_ids))
-                        phrase_queries_attention_mask.append(
-                            torch.tensor(phrase_attention_mask)
-                        )
-
-
-                for i, entity in enumerate(entities):
-                    if len(t_bboxes[i]) > 0:
-                        img_height = self.localized_narratives_testval_data[
-                            phrase_file[0]
-                        ]["img_height"]
-                        img_width = self.localized_narratives_testval_data[
-                            phrase_file[0]
-                        ]["img_width"]
-
-                        bbox = t_bboxes[i][0]
-                        x = (bbox[0] * img_width) / 100.0
-                        y = (bbox[1] * img_height) / 100.0
-                        w = (bbox[2] * img_width) / 100.0
-                        h = (bbox[3] * img_height) / 100.0
-                        left = int(x)
-                        top = int(y)
-                        right = int(x + w)
-                        bottom = int(y + h)
-                        target_bboxes.append([[left, top, right, bottom]])
-                    else:
-                        target_bboxes.append([[0.0, 0.0, 0.0, 0.0]])
-                gt_coref_matrix = data_utils.get_gt_coref_matrix(entities, clusters)
-                rule_coref_matrix = np.zeros((len(phrase_queries), len(phrase_queries)))
+                pos_tags.append("NN")
+
+        return {
+            "caption": caption_seq,
+            "phrase_queries": phrase_queries,
+            "phrase_start_end": phrase_queries_start_end_idx,
+            "phrase_input_ids": phrase_queries_input_ids,
+            "phrase_attention_mask": phrase_queries_attention_mask,
+            "pos_tags": pos_tags,
+            "sense2vec_feats": self._sense2vec_feats(doc),
+            "target_bboxes": target_bboxes,
+            "coref_clusters": data_utils.coref_cluster_ids([], len(phrase_queries)),
+            "max_assignments": max_assignments,
+            "caption_input_ids": caption_input_ids,
+        }
+
+    def build_text_features(self, image_id, labels, docs=None):
+        """docs: optional (caption doc, {phrase: doc}) parsed ahead of time."""
+        if self.split == "train":
+            if self._is_train_image(image_id):
+                text_features = self._build_train_caption_features(image_id, docs)
+            else:
+                text_features = self._build_annotated_train_features(image_id, docs)
+        else:
+            text_features = self._build_eval_features(image_id, docs)
+
+        if "caption_input_ids" not in text_features:
+            text_features["caption_input_ids"] = tokenization.encode_caption(
+                self.tokenizer, text_features["caption"], self.max_caption_length
+            )[0]
+        (
+            object_label_input_ids,
+            object_label_attn_mask,
+        ) = self._encode_object_labels(labels)
+        text_features.update(
+            version=TEXT_CACHE_VERSION,
+            object_label_input_ids=object_label_input_ids,
+            object_label_attention_mask=object_label_attn_mask,
+        )
+        return text_features
 
-            if self.sentence_patch_sim:
-                sentences = str.split(caption_seq, ".")
-                max_num_sentences = 16
-                (
-                    clip_img_embeds,
-                    patch_sentence_sim,
-                ) = patch_sentence_similarity_clip.clip_sentence_patch_similarity(
-                    sentences, image_dir, str(image_id), clip_model, clip_processor
-                )
-                sense2vec_sentence_feats = []
-                for s in range(len(sentences)):
-                    doc = nlp(str(sentences[s]))
-                    sense2vec_single_feats = []
-                    for k in range(32):
-                        try:
-                            sense2vec_single_feats.append(
-                                torch.tensor(doc[k]._.s2v_vec)
-                            )
-                        except:
-                            sense2vec_single_feats.append(torch.tensor([0.0] * 128))
-
-                    sense2vec_single_feats = torch.stack(sense2vec_single_feats)
-                    sense2vec_sentence_feats.append((sense2vec_single_feats))
-                sense2vec_sentence_feats = (
-                    torch.stack(sense2vec_sentence_feats).numpy().tolist()
-                )
-                s_encoded = self.tokenizer.batch_encode_plus(
-                    batch_text_or_text_pairs=tuple(
-                        sentences
-                    ),
-                    add_special_tokens=False,
-                    max_length=32,
-                    pad_to_max_length=True,
-                    return_attention_mask=True,
-                    return_tensors="pt",
+    def _cache_split(self):
+        return self.split + ("_grounding" if self.eval_grounding else "")
+
+    def _text_cache_path(self, image_id):
+        return os.path.join(
+            self.cache_dir, self._cache_split(), "%s.pkl" % str(image_id)
+        )
+
+    def _length_index_path(self):
+        return os.path.join(self.cache_dir, self._cache_split(), "lengths.npz")
+
+    def _load_length_index(self):
+        if not self.cache_dir or not os.path.exists(self._length_index_path()):
+            return {}
+        index = np.load(self._length_index_path())
+        return dict(zip(index["image_ids"].tolist(), index["lengths"].tolist()))
+
+    def caption_lengths(self):
+        length_index = self._load_length_index()
+        lengths = np.zeros(len(self.image_ids), dtype=np.int64)
+        for i, image_id in enumerate(self.image_ids):
+            if int(image_id) not in length_index:
+                text_features = self.load_text_features(
+                    image_id, self._get_detection_labels(image_id)
                 )
-                sentence_input_ids = s_encoded["input_ids"].tolist()
-                sentence_attn_mask = s_encoded["attention_mask"].tolist()
-                padbox = [0.0] * 32
-                padbox_s2v = torch.zeros((32, 128)).numpy().tolist()
-                while len(sentence_input_ids) < max_num_sentences:
-                    sentence_input_ids.append(padbox)
-                    sentence_attn_mask.append(padbox)
-                    sense2vec_sentence_feats.append(padbox_s2v)
-                sentence_input_ids = torch.tensor(sentence_input_ids)[
-                                     :max_num_sentences
-                                     ]
-                sentence_attn_mask = torch.tensor(sentence_attn_mask)[
-                                     :max_num_sentences
-                                     ]
-                sense2vec_sentence_feats = torch.tensor(sense2vec_sentence_feats)[
-                                           :max_num_sentences
-                                           ]
-                patch_sentence_sim = (patch_sentence_sim).numpy()
-                sen_len = len(sentences)
-                if len(sentences) > max_num_sentences:
-                    sen_len = max_num_sentences
-                pad_width = max_num_sentences - sen_len
-                patch_sentence_sim = np.pad(
-                    patch_sentence_sim, (0, pad_width), mode="constant"
-                )[: len(clip_img_embeds), :max_num_sentences]
-                patch_sentence_sim = torch.tensor(patch_sentence_sim)
-                num_sentences = min(sen_len, max_num_sentences)
-        else:
-            mouse_trace_for_phrases = []
-            phrase_file = [
-                idx
-                for idx in range(len(self.localized_narratives_testval_data))
-                if self.localized_narratives_testval_data[idx]["image"] == str(image_id)
-            ]
+                length_index[int(image_id)] = len(text_features["caption_input_ids"])
+            lengths[i] = length_index[int(image_id)]
+        return lengths
+
+    def write_length_index(self):
+        length_index = self._load_length_index()
+        length_index.update(
+            zip([int(image_id) for image_id in self.image_ids], self.caption_lengths())
+        )
+        cache_path = self._length_index_path()
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                image_ids=np.array(list(length_index.keys()), dtype=np.int64),
+                lengths=np.array(list(length_index.values()), dtype=np.int64),
+            )
+        os.replace(tmp_path, cache_path)
 
-            caption_seq = self.localized_narratives_testval_data[phrase_file[0]][
-                "captions"
-            ]
-            org_entities = self.localized_narratives_testval_data[phrase_file[0]][
-                "query"
-            ]
-            org_t_bboxes = self.localized_narratives_testval_data[phrase_file[0]][
-                "target_bboxes"
-            ]
-            org_clusters = self.localized_narratives_testval_data[phrase_file[0]][
-                "cluster"
-            ]
+    def _get_detection_labels(self, image_id):
+        if self._is_train_image(image_id) or self.split == "test":
+            return self.obj_detection_dict[str(image_id)]["classes"]
+        return self.val_obj_detection_dict[str(image_id)]["classes"]
 
-            query_start_end_char_index = self.localized_narratives_testval_data[
-                phrase_file[0]
-            ][
-                "query_start_end"
+    def write_text_cache_shard(
+        self, indices, overwrite=False, n_process=1, batch_size=64
+    ):
+        """Parse a shard of captions and phrases with nlp.pipe and cache them."""
+        image_ids = [self.image_ids[index] for index in indices]
+        if not overwrite:
+            image_ids = [
+                image_id
+                for image_id in image_ids
+                if not os.path.exists(self._text_cache_path(image_id))
             ]
-            query_start_char_list = []
-            for start_end in query_start_end_char_index:
-                query_start_char_list.append(start_end[0])
-            sorted_query_char_idx = sorted(
-                range(len(query_start_char_list)),
-                key=lambda k: query_start_char_list[k],
-            )
-            entities = [org_entities[x] for x in sorted_query_char_idx]
-            t_bboxes = [org_t_bboxes[x] for x in sorted_query_char_idx]
-            clusters = [org_clusters[x] for x in sorted_query_char_idx]
-            sort_query_start_end_char_index = [
-                query_start_end_char_index[x] for x in sorted_query_char_idx
+        if len(image_ids) == 0:
+            return
+        texts = [self._texts_to_parse(image_id) for image_id in image_ids]
+        phrases = list(
+            dict.fromkeys(p for _, shard_phrases in texts for p in shard_phrases)
+        )
+        phrase_docs = dict(
+            zip(phrases, nlp.pipe(phrases, n_process=n_process, batch_size=batch_size))
+        )
+        caption_docs = nlp.pipe(
+            [caption for caption, _ in texts],
+            n_process=n_process,
+            batch_size=batch_size,
+        )
+        for image_id, caption_doc in zip(image_ids, caption_docs):
+            text_features = self.build_text_features(
+                image_id,
+                self._get_detection_labels(image_id),
+                docs=(caption_doc, phrase_docs),
+            )
+            cache_path = self._text_cache_path(image_id)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(text_features, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+
+    def load_text_features(self, image_id, labels):
+        if self.cache_dir:
+            cache_path = self._text_cache_path(image_id)
+            if os.path.exists(cache_path):
+                with open(cache_path, "rb") as f:
+                    text_features = pickle.load(f)
+                if text_features.get("version") == TEXT_CACHE_VERSION:
+                    return text_features
+        return self.build_text_features(image_id, labels)
+
+    def __getitem__(self, index):
+        image_id = self.image_ids[index]
+        image_dir = os.path.join(self.dataroot, "flickr30k-images")
+
+        feature, bboxes, labels = self._get_image_features(image_id)
+        text_features = self.load_text_features(image_id, labels)
+        caption_seq = text_features["caption"]
+
+        if self.split == "train" and self.sentence_patch_sim:
+            sentences = str.split(caption_seq, ".")
+            max_num_sentences = 16
+            (
+                clip_img_embeds,
+                patch_sentence_sim,
+            ) = patch_sentence_similarity_clip.clip_sentence_patch_similarity(
+                sentences, image_dir, str(image_id), clip_model, clip_processor
+            )
+            sense2vec_sentence_feats = [
+                self.sense2vec.doc_features(doc, length=32).astype(np.float32).tolist()
+                for doc in nlp.pipe([str(sentence) for sentence in sentences])
             ]
-            tokenized_caption_seq = self.tokenizer.tokenize(caption_seq)
-            query_start_end = []
-            query_char_start_end = []
-            phrase_queries = []
-            target_bboxes = []
-            phrase_queries_input_ids = []
-            phrase_queries_attention_mask = []
-            phrase_queries_start_end_idx = []
-            sense2vec_feats = []
-            max_assignments = []
-            rel_phrases = []
-            pos_tags = []
-            rel_query_start_end = []
-
-            doc = nlp(str(caption_seq))
-            for k in range(len(doc)):
-                try:
-                    sense2vec_feats.append(torch.tensor(doc[k]._.s2v_vec))
-                except:
-                    sense2vec_feats.append(torch.tensor([0.0] * 128))
-            entities = entities[: self.max_queries]
-            char_indx = -1
-            count = 0
-            for k in clusters:
-                for i in range(len(clusters)):
-                    if k == clusters[i]:
-                        count = count + 1
-                max_assignments.append(count)
-                count = 0
-
-            if len(entities) > 0:
-                for edx, entity in enumerate(entities):
-                    start, end, char_indx = data_utils.find_sublist(
-                        tokenized_caption_seq,
-                        self.tokenizer.tokenize(entity),
-                        char_indx + 1,
-                    )
-                    start_c = sort_query_start_end_char_index[edx][0]
-                    end_c = sort_query_start_end_char_index[edx][1] - 1
-                    query_char_start_end.append([start_c, end_c])
-                    query_start_end.append([start, end])
-                for i, entity in enumerate(entities):
-                    if len(t_bboxes[i]) > 0:
-                        img_height = self.localized_narratives_testval_data[
-                            phrase_file[0]
-                        ]["img_height"]
-                        img_width = self.localized_narratives_testval_data[
-                            phrase_file[0]
-                        ]["img_width"]
-                        phrase_queries.append(entity)
-                        phrase_queries_start_end_idx.append(query_start_end[i])
-
-                        phrase_input_ids = []
-                        phrase_attention_mask = []
-                        s = self.tokenizer.tokenize(entity)
-                        lis = [0] * self.max_query_length
-                        attn_masks = [0] * self.max_query_length
-                        for k in range(min(len(s), self.max_query_length)):
-                            lis[k] = max(self.indexer.index_of(s[k]), 1)
-                            attn_masks[k] = 1
-                        phrase_input_ids.append(lis)
-                        phrase_attention_mask.append(attn_masks)
-                        phrase_queries_input_ids.append(torch.tensor(phrase_input_ids))
-                        phrase_queries_attention_mask.append(
-                            torch.tensor(phrase_attention_mask)
-                        )
-
-                    for bdx in range(len(t_bboxes[i])):
-                        bbox = t_bboxes[i][bdx]
-                        x = (bbox[0] * img_width) / 100.0
-                        y = (bbox[1] * img_height) / 100.0
-                        w = (bbox[2] * img_width) / 100.0
-                        h = (bbox[3] * img_height) / 100.0
-                        left = int(x)
-                        top = int(y)
-                        right = int(x + w)
-                        bottom = int(y + h)
-
-                        target_bboxes.append([[left, top, right, bottom]])
-
-                    if self.eval_grounding:
-                        if len(t_bboxes[i]) > 1:
-                            for _ in range(len(t_bboxes[i]) - 1):
-                                phrase_queries.append(entity)
-                                phrase_queries_start_end_idx.append(query_start_end[i])
-                                phrase_queries_input_ids.append(
-                                    torch.tensor(phrase_input_ids)
-                                )
-                                phrase_queries_attention_mask.append(
-                                    torch.tensor(phrase_attention_mask)
-                                )
-            gt_coref_matrix = np.zeros((len(phrase_queries), len(phrase_queries)))
-            for k, entity in enumerate(phrase_queries):
-                spacy_entity = nlp(entity)
-                spacy_entity_np = list(spacy_entity.noun_chunks)
-                if len(spacy_entity_np) > 0:
-                    pos_tags.append(spacy_entity_np[-1].root.tag_)
-                else:
-                    pos_tags.append("NN")
-
-                rel_query_start_end.append(phrase_queries_start_end_idx[k])
-
-                rel_phrases.append(entity)
-            rule_coref_matrix = np.zeros((len(phrase_queries), len(phrase_queries)))
-        padbox = [0.0, 0.0, 0.0, 0.0]
+            s_encoded = self.tokenizer.batch_encode_plus(
+                batch_text_or_text_pairs=tuple(
+                    sentences
+                ),
+                add_special_tokens=False,
+                max_length=32,
+                pad_to_max_length=True,
+                return_attention_mask=True,
+                return_tensors="pt",
+            )
+            sentence_input_ids = s_encoded["input_ids"].tolist()
+            sentence_attn_mask = s_encoded["attention_mask"].tolist()
+            padbox = [0.0] * 32
+            padbox_s2v = torch.zeros((32, 128)).numpy().tolist()
+            while len(sentence_input_ids) < max_num_sentences:
+                sentence_input_ids.append(padbox)
+                sentence_attn_mask.append(padbox)
+                sense2vec_sentence_feats.append(padbox_s2v)
+            sentence_input_ids = torch.tensor(sentence_input_ids)[
+                                 :max_num_sentences
+                                 ]
+            sentence_attn_mask = torch.tensor(sentence_attn_mask)[
+                                 :max_num_sentences
+                                 ]
+            sense2vec_sentence_feats = torch.tensor(sense2vec_sentence_feats)[
+                                       :max_num_sentences
+                                       ]
+            patch_sentence_sim = (patch_sentence_sim).numpy()
+            sen_len = len(sentences)
+            if len(sentences) > max_num_sentences:
+                sen_len = max_num_sentences
+            pad_width = max_num_sentences - sen_len
+            patch_sentence_sim = np.pad(
+                patch_sentence_sim, (0, pad_width), mode="constant"
+            )[: len(clip_img_embeds), :max_num_sentences]
+            patch_sentence_sim = torch.tensor(patch_sentence_sim)
+            num_sentences = min(sen_len, max_num_sentences)
+
         num_obj = min(len(labels), self.max_detected_boxes)
-        while len(target_bboxes) < self.max_queries:
-            target_bboxes.append([padbox])
-
-        encoded = self.tokenizer.encode_plus(
-            text=caption_seq,
-            add_special_tokens=False,
-            max_length=self.max_caption_length,
-            pad_to_max_length=True,
-            return_attention_mask=True,
-            return_tensors="pt",
-        )
-
-        caption_input_ids = torch.tensor(encoded["input_ids"])
-        caption_attn_mask = torch.tensor(encoded["attention_mask"])
-        num_query = min(len(phrase_queries), self.max_queries)
-
-        while len(phrase_queries) < self.max_queries:
-            phrase_queries.append("")
-            phrase_queries_start_end_idx.append([0] * 2)
-
-        phrase_queries = phrase_queries[: self.max_queries]
-        phrase_queries_start_end_idx = phrase_queries_start_end_idx[: self.max_queries]
-
-        while len(phrase_queries_input_ids) < self.max_queries:
-            phrase_queries_input_ids.append(
-                torch.zeros((1, self.max_query_length), dtype=int)
-            )
-            phrase_queries_attention_mask.append(
-                torch.zeros((1, self.max_query_length), dtype=int)
-            )
-
-        phrase_queries_input_ids = torch.stack(phrase_queries_input_ids)
-        phrase_queries_attention_mask = torch.stack(phrase_queries_attention_mask)
-        phrase_queries_input_ids = phrase_queries_input_ids[: self.max_queries]
-        phrase_queries_attention_mask = phrase_queries_attention_mask[
-                                        : self.max_queries
-                                        ]
-
-        while len(sense2vec_feats) < self.max_caption_length:
-            sense2vec_feats.append(torch.tensor([0.0] * 128))
-        pad_width = self.max_queries - num_query
-        gt_coref_matrix = np.pad(gt_coref_matrix, (0, pad_width), mode="constant")
-        gt_coref_matrix = gt_coref_matrix[: self.max_queries, : self.max_queries]
-        rule_coref_matrix = np.pad(rule_coref_matrix, (0, pad_width), mode="constant")
-        rule_coref_matrix = rule_coref_matrix[: self.max_queries, : self.max_queries]
-        assert len(phrase_queries) == self.max_queries
-        assert len(phrase_queries_start_end_idx) == self.max_queries
+        object_label_input_ids = torch.from_numpy(
+            text_features["object_label_input_ids"][:num_obj]
+        )
+        object_label_attn_mask = torch.from_numpy(
+            text_features["object_label_attention_mask"][:num_obj]
+        )
+        if self.encoding_type != "glove":
+            object_label_input_ids = object_label_input_ids.unsqueeze(1)
+            object_label_attn_mask = object_label_attn_mask.unsqueeze(1)
+
+        phrase_queries = list(text_features["phrase_queries"][: self.max_queries])
+        num_query = len(phrase_queries)
+        phrase_queries_start_end_idx = torch.tensor(
+            text_features["phrase_start_end"][:num_query], dtype=torch.long
+        ).reshape(-1, 2)
+        phrase_queries_input_ids = torch.tensor(
+            text_features["phrase_input_ids"][:num_query], dtype=torch.long
+        ).reshape(-1, 1, self.max_query_length)
+        phrase_queries_attention_mask = torch.tensor(
+            text_features["phrase_attention_mask"][:num_query], dtype=torch.long
+        ).reshape(-1, 1, self.max_query_length)
+        target_bboxes = torch.tensor(
+            text_features["target_bboxes"], dtype=torch.float
+        ).reshape(-1, 1, 4)
+
+        caption_input_ids = torch.from_numpy(
+            text_features["caption_input_ids"]
+        ).unsqueeze(0)
+        caption_attn_mask = torch.ones_like(caption_input_ids, dtype=torch.bool)
+        sense2vec_feats = torch.from_numpy(
+            text_features["sense2vec_feats"][: self.max_caption_length]
+        )
+
+        mouse_trace_for_phrases = torch.tensor([])
+        # cluster ids only; the matrix is expanded on device (utils.coref_matrix)
+        gt_coref_matrix = torch.from_numpy(
+            text_features["coref_clusters"][: self.max_queries]
+        )
+        rule_coref_matrix = torch.zeros((num_query, num_query), dtype=torch.uint8)
+
+        if self.pad_to_max:
+            object_label_input_ids = batching.pad_to_shape(
+                object_label_input_ids,
+                (self.max_detected_boxes,) + tuple(object_label_input_ids.shape[1:]),
+            )
+            object_label_attn_mask = batching.pad_to_shape(
+                object_label_attn_mask,
+                (self.max_detected_boxes,) + tuple(object_label_attn_mask.shape[1:]),
+            )
+            feature = batching.pad_to_shape(
+                feature, (self.max_detected_boxes, feature.size(1))
+            )
+            bboxes = batching.pad_to_shape(bboxes, (self.max_detected_boxes, 5))
+            if self.return_phrases:
+                phrase_queries = phrase_queries + [""] * (self.max_queries - num_query)
+            phrase_queries_start_end_idx = batching.pad_to_shape(
+                phrase_queries_start_end_idx, (self.max_queries, 2)
+            )
+            phrase_queries_input_ids = batching.pad_to_shape(
+                phrase_queries_input_ids, (self.max_queries, 1, self.max_query_length)
+            )
+            phrase_queries_attention_mask = batching.pad_to_shape(
+                phrase_queries_attention_mask,
+                (self.max_queries, 1, self.max_query_length),
+            )
+            target_bboxes = batching.pad_to_shape(
+                target_bboxes, (max(len(target_bboxes), self.max_queries), 1, 4)
+            )
+            caption_input_ids = batching.pad_to_shape(
+                caption_input_ids, (1, self.max_caption_length)
+            )
+            caption_attn_mask = batching.pad_to_shape(
+                caption_attn_mask, (1, self.max_caption_length)
+            )
+            sense2vec_feats = batching.pad_to_shape(
+                sense2vec_feats, (self.max_caption_length, 128)
+            )
+            gt_coref_matrix = batching.pad_to_shape(
+                gt_coref_matrix, (self.max_queries,), value=-1
+            )
+            rule_coref_matrix = batching.pad_to_shape(
+                rule_coref_matrix, (self.max_queries, self.max_queries)
+            )
+            assert len(phrase_queries_start_end_idx) == self.max_queries
+        if not self.return_phrases:
+            phrase_queries = None
         if self.split == "train":
             if self.sentence_patch_sim:
                 return (
@@ -829,71 +877,73 @@ class LocalizedNarrativesFlickr30dataset(Dataset):
                     object_label_input_ids,
                     object_label_attn_mask,
                     bboxes,
-                    torch.tensor(phrase_queries_input_ids),
-                    torch.tensor(phrase_queries_attention_mask),
-                    torch.tensor(caption_input_ids),
-                    torch.tensor(caption_attn_mask),
-                    torch.stack(sense2vec_feats),
+                    phrase_queries_input_ids,
+                    phrase_queries_attention_mask,
+                    caption_input_ids,
+                    caption_attn_mask,
+                    sense2vec_feats,
                     torch.tensor(num_sentences),
                     clip_img_embeds,
                     sentence_input_ids,
                     sentence_attn_mask,
                     sense2vec_sentence_feats,
                     patch_sentence_sim,
-                    torch.tensor(phrase_queries_start_end_idx),
+                    phrase_queries_start_end_idx,
                     torch.tensor(num_obj),
                     torch.tensor(num_query),
-                    torch.tensor(target_bboxes),
-                    torch.tensor(mouse_trace_for_phrases),
-                    torch.tensor(caption_attn_mask),
-                    torch.tensor(gt_coref_matrix),
-                    torch.tensor(rule_coref_matrix),
+                    target_bboxes,
+                    mouse_trace_for_phrases,
+                    caption_attn_mask,
+                    gt_coref_matrix,
+                    rule_coref_matrix,
                 )
             else:
-                return (
+                return batching.compact_sample(
+                    (
+                        torch.tensor(int(image_id)),
+                        phrase_queries,
+                        feature,
+                        object_label_input_ids,
+                        object_label_attn_mask,
+                        bboxes,
+                        phrase_queries_input_ids,
+                        phrase_queries_attention_mask,
+                        caption_input_ids,
+                        caption_attn_mask,
+                        sense2vec_feats,
+                        phrase_queries_start_end_idx,
+                        torch.tensor(num_obj),
+                        torch.tensor(num_query),
+                        target_bboxes,
+                        mouse_trace_for_phrases,
+                        gt_coref_matrix,
+                        rule_coref_matrix,
+                    )
+                )
+
+        else:
+            return batching.compact_sample(
+                (
                     torch.tensor(int(image_id)),
                     phrase_queries,
                     feature,
                     object_label_input_ids,
                     object_label_attn_mask,
                     bboxes,
-                    torch.tensor(phrase_queries_input_ids),
-                    torch.tensor(phrase_queries_attention_mask),
-                    torch.tensor(caption_input_ids),
-                    torch.tensor(caption_attn_mask),
-                    torch.stack(sense2vec_feats),
-                    torch.tensor(phrase_queries_start_end_idx),
+                    phrase_queries_input_ids,
+                    phrase_queries_attention_mask,
+                    caption_input_ids,
+                    caption_attn_mask,
+                    sense2vec_feats,
+                    phrase_queries_start_end_idx,
                     torch.tensor(num_obj),
                     torch.tensor(num_query),
-                    torch.tensor(target_bboxes),
-                    torch.tensor(mouse_trace_for_phrases),
-                    torch.tensor(caption_attn_mask),
-                    torch.tensor(gt_coref_matrix),
-                    torch.tensor(rule_coref_matrix),
+                    target_bboxes,
+                    mouse_trace_for_phrases,
+                    gt_coref_matrix,
+                    rule_coref_matrix,
+                    torch.tensor(text_features["max_assignments"]),
                 )
-
-        else:
-            return (
-                torch.tensor(int(image_id)),
-                phrase_queries,
-                feature,
-                object_label_input_ids,
-                object_label_attn_mask,
-                bboxes,
-                torch.tensor(phrase_queries_input_ids),
-                torch.tensor(phrase_queries_attention_mask),
-                torch.tensor(caption_input_ids),
-                torch.tensor(caption_attn_mask),
-                torch.stack(sense2vec_feats),
-                torch.tensor(phrase_queries_start_end_idx),
-                torch.tensor(num_obj),
-                torch.tensor(num_query),
-                torch.tensor(target_bboxes),
-                torch.tensor(mouse_trace_for_phrases),
-                torch.tensor(caption_attn_mask),
-                torch.tensor(gt_coref_matrix),
-                torch.tensor(rule_coref_matrix),
-                torch.tensor(max_assignments),
             )
 
     def __len__(self):
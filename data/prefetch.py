@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+
+import torch
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class PrefetchStats(object):
+    """Queue depth and wait time seen by the training loop.
+
+    depth is the number of ready batches when the loop asks for the next one;
+    a mean depth near zero and a high empty fraction mean training is
+    waiting on data.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.depth_total = 0
+        self.empty = 0
+        self.wait_time = 0.0
+
+    def update(self, depth, wait_time):
+        self.batches += 1
+        self.depth_total += depth
+        self.empty += int(depth == 0)
+        self.wait_time += wait_time
+
+    def summary(self):
+        n = max(self.batches, 1)
+        return {
+            "batches": self.batches,
+            "capacity": self.capacity,
+            "mean_depth": self.depth_total / n,
+            "empty_fraction": self.empty / n,
+            "wait_ms_per_batch": 1e3 * self.wait_time / n,
+        }
+
+
+class PrefetchLoader(object):
+    """Keep `depth` batches on device ahead of the training loop.
+
+    Batches are produced by the wrapped DataLoader (use worker processes and
+    pin_memory there) and moved to device by a background thread, on a
+    separate CUDA stream when the device is a GPU, so the host-to-device copy
+    of the next batches overlaps the current step. Batches must provide
+    to(device, non_blocking) and tensors(), like batching.Batch.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.stats = PrefetchStats(depth)
+        self.stream = None
+        if self.device.type == "cuda" and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream(device=self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    # sampler / batch_sampler / dataset of the wrapped loader (batching.set_epoch)
+    def __getattr__(self, name):
+        if name == "loader":
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _put(self, ready, stop, item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, ready, stop):
+        try:
+            for batch in self.loader:
+                if self.stream is not None:
+                    # the stream knows its device index even when self.device
+                    # is a bare torch.device("cuda")
+                    with torch.cuda.device(self.stream.device):
+                        with torch.cuda.stream(self.stream):
+                            batch = batch.to(self.device, non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                else:
+                    batch, event = batch.to(self.device), None
+                if not self._put(ready, stop, (batch, event)):
+                    return
+        except Exception as exc:
+            self._put(ready, stop, _Failure(exc))
+            return
+        self._put(ready, stop, _END)
+
+    def _consume(self, item):
+        batch, event = item
+        if event is not None:
+            current = torch.cuda.current_stream(self.stream.device)
+            current.wait_event(event)
+            # the tensors were allocated on the copy stream; keep the allocator
+            # from reusing them while the compute stream still needs them
+            for tensor in batch.tensors().values():
+                tensor.record_stream(current)
+        return batch
+
+    def __iter__(self):
+        ready = queue.Queue(maxsize=max(self.depth, 1))
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(ready, stop), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                depth = ready.qsize()
+                t = time.perf_counter()
+                item = ready.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exc
+                self.stats.update(depth, time.perf_counter() - t)
+                yield self._consume(item)
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+import numpy as np
+
+SENSE2VEC_DIM = 128
+
+_open_tables = {}
+
+
+def open_table(path):
+    if path not in _open_tables:
+        from sense2vec import Sense2Vec
+
+        _open_tables[path] = Sense2Vec().from_disk(path)
+    return _open_tables[path]
+
+
+class Sense2VecFeatures(object):
+    """Per-token sense2vec vectors with an LRU cache keyed by (text, POS).
+
+    With a sense2vec table loaded (see load) vectors are looked up directly.
+    Otherwise they are read from the token._.s2v_vec extension when a
+    sense2vec pipe is part of the spaCy pipeline, and are zero when it is not.
+    """
+
+    def __init__(self, s2v=None, cache_size=65536, dtype=np.float32, path=None):
+        self.s2v = s2v
+        self.cache_size = cache_size
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self._cache = OrderedDict()
+        self._zero = np.zeros(SENSE2VEC_DIM, dtype=self.dtype)
+
+    @classmethod
+    def load(cls, path=None, cache_size=65536, dtype=np.float32):
+        if path is None:
+            return cls(cache_size=cache_size, dtype=dtype)
+        return cls(open_table(path), cache_size=cache_size, dtype=dtype, path=path)
+
+    # the table is reloaded from path rather than pickled into every worker
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        if self.path is not None:
+            state["s2v"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.s2v is None and self.path is not None:
+            self.s2v = open_table(self.path)
+
+    def _lookup(self, token):
+        if self.s2v is not None:
+            key = self.s2v.make_key(token.text, token.pos_)
+            if key in self.s2v:
+                return np.asarray(self.s2v[key], dtype=self.dtype)
+            return self._zero
+        try:
+            vec = np.asarray(token._.s2v_vec, dtype=self.dtype)
+        except Exception:
+            return self._zero
+        return vec if vec.shape == self._zero.shape else self._zero
+
+    def vector(self, token):
+        key = (token.text, token.pos_)
+        vec = self._cache.get(key)
+        if vec is None:
+            vec = self._lookup(token)
+            self._cache[key] = vec
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return vec
+
+    def doc_features(self, doc, length=None):
+        """(length or len(doc), 128) array of the token vectors, zero padded."""
+        n_rows = len(doc) if length is None else length
+        feats = np.zeros((n_rows, SENSE2VEC_DIM), dtype=self.dtype)
+        for k in range(min(len(doc), n_rows)):
+            feats[k] = self.vector(doc[k])
+        return feats
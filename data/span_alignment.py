@@ -0,0 +1,26 @@
+import numpy as np
+
+
+def phrase_char_spans(start_end, phrases):
+    """[start, end) character spans of phrases given their start offsets."""
+    starts = np.array([se[0] for se in start_end], dtype=np.int64)
+    lengths = np.array([len(phrase) for phrase in phrases], dtype=np.int64)
+    return np.stack((starts, starts + lengths), axis=-1).reshape(-1, 2)
+
+
+def char_to_token_spans(offsets, char_spans):
+    """Map [start, end) character spans to inclusive [first, last] token spans.
+
+    offsets is the (T, 2) offset mapping of the tokenized caption. A span
+    covers every token overlapping it; spans that overlap no token map to
+    (0, 0), like data_utils.find_sublist does on failure.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    char_spans = np.asarray(char_spans, dtype=np.int64).reshape(-1, 2)
+    # first token ending after the span start, last token starting before its end
+    first = np.searchsorted(offsets[:, 1], char_spans[:, 0], side="right")
+    last = np.searchsorted(offsets[:, 0], char_spans[:, 1], side="left") - 1
+    valid = (first <= last) & (first < len(offsets))
+    token_spans = np.stack((first, last), axis=-1)
+    token_spans[~valid] = 0
+    return token_spans
@@ -0,0 +1,80 @@
+import numpy as np
+from transformers import BertTokenizer
+
+try:
+    from transformers import BertTokenizerFast
+except ImportError:
+    BertTokenizerFast = None
+
+
+def load_tokenizer(name):
+    """Fast (Rust) BERT tokenizer, or the Python one when it is unavailable."""
+    if BertTokenizerFast is not None:
+        try:
+            return BertTokenizerFast.from_pretrained(name)
+        except (OSError, ValueError, ImportError):
+            pass
+    return BertTokenizer.from_pretrained(name)
+
+
+def is_fast(tokenizer):
+    return getattr(tokenizer, "is_fast", False)
+
+
+def tokenize_batch(tokenizer, texts):
+    """Wordpiece tokens of every text, as tokenizer.tokenize would return them."""
+    texts = [str(text) for text in texts]
+    if len(texts) == 0:
+        return []
+    if not is_fast(tokenizer):
+        return [tokenizer.tokenize(text) for text in texts]
+    encoded = tokenizer(texts, add_special_tokens=False, return_attention_mask=False)
+    return [tokenizer.convert_ids_to_tokens(ids) for ids in encoded["input_ids"]]
+
+
+def encode_labels(tokenizer, labels, max_length=16):
+    """(n, max_length) input ids and attention mask of all object labels."""
+    if len(labels) == 0:
+        empty = np.zeros((0, max_length), dtype=np.int64)
+        return empty, empty.copy()
+    encoded = tokenizer(
+        [str(label) for label in labels],
+        add_special_tokens=False,
+        max_length=max_length,
+        padding="max_length",
+        truncation=True,
+        return_attention_mask=True,
+    )
+    return (
+        np.array(encoded["input_ids"], dtype=np.int64),
+        np.array(encoded["attention_mask"], dtype=np.int64),
+    )
+
+
+def encode_caption(tokenizer, caption, max_length):
+    """Encode a caption once.
+
+    Returns the input ids truncated to max_length, the wordpiece tokens of the
+    whole caption and their (start, end) character offsets, or None for
+    offsets when the tokenizer is not a fast one.
+    """
+    if is_fast(tokenizer):
+        encoded = tokenizer(
+            caption,
+            add_special_tokens=False,
+            return_attention_mask=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        offsets = np.array(encoded["offset_mapping"], dtype=np.int64).reshape(-1, 2)
+    else:
+        encoded = tokenizer(
+            caption, add_special_tokens=False, return_attention_mask=False, verbose=False
+        )
+        offsets = None
+    input_ids = encoded["input_ids"]
+    return (
+        np.array(input_ids[:max_length], dtype=np.int64),
+        tokenizer.convert_ids_to_tokens(input_ids),
+        offsets,
+    )
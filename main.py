@@ -10,6 +10,9 @@ from torch.utils.data import DataLoader
 import torch.nn as nn
 from data import localized_narratives_pretrain_loader
 from data import data_utils
+from data import batching
+from data import eval_cache
+from data import prefetch
 from train import train_model
 from models.mcr import BertPretrain
 
@@ -86,6 +89,22 @@ def parse_args():
         help="use transformation function to learn hm",
     )
 
+    parser.add_argument(
+        "--teacher-source",
+        type=str,
+        default="forward",
+        choices=["forward", "ema"],
+        help="label propagation targets. forward: an extra no-grad pass of the "
+        "student (exact, one more forward per step). ema: EMA model outputs cached "
+        "per image and recomputed every --teacher-refresh epochs (one EMA pass per "
+        "image per refresh, targets up to that many epochs old)",
+    )
+    parser.add_argument(
+        "--teacher-refresh",
+        type=int,
+        default=2,
+        help="epochs a cached EMA target is reused with --teacher-source ema",
+    )
     parser.add_argument("--ema-decay", default=0.999, type=float, help="EMA decay rate")
     parser.add_argument("--device", default="cuda")
     parser.add_argument("--seed", default=, type=int)
@@ -124,6 +143,63 @@ def parse_args():
     parser.add_argument(
         "--cooldown_epochs", type=int, default=0, help="cooldown epochs"
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="datasets/preprocessed",
+        help="per-image text cache written by preprocess.py",
+    )
+    parser.add_argument(
+        "--sense2vec",
+        type=str,
+        default=None,
+        help="sense2vec vectors directory, used for captions missing from the cache",
+    )
+    parser.add_argument(
+        "--dynamic-padding",
+        action="store_true",
+        help="pad each train/ssl batch to its longest sample and bucket by length",
+    )
+    parser.add_argument(
+        "--bucket-size", type=int, default=50, help="batches per length bucket"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=4,
+        help="DataLoader worker processes of the train and ssl loaders",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="train/ssl batches kept on device ahead of the step (0: no prefetching)",
+    )
+    parser.add_argument(
+        "--ssl-ratio",
+        type=int,
+        default=1,
+        help="ssl batches trained on per labeled batch when --use-ssl is set",
+    )
+    parser.add_argument(
+        "--eval-cache",
+        type=str,
+        default="none",
+        choices=["none", "pinned", "device"],
+        help="collate the test set once and keep it in pinned memory or on device",
+    )
+    parser.add_argument(
+        "--eval-every",
+        type=int,
+        default=0,
+        help="also evaluate every N training steps (0: only at the end of each epoch)",
+    )
+    parser.add_argument(
+        "--eval-batches",
+        type=int,
+        default=0,
+        help="number of test batches sampled for step evaluations (0: all)",
+    )
 
     args = parser.parse_args()
     return args
@@ -146,7 +222,9 @@ if __name__ == "__main__":
     if torch.cuda.device_count() >= 1:
         print("Use {} gpus".format(torch.cuda.device_count()))
 
-    wordEmbedding = data_utils.load_vocabulary("datasets/glove/glove.6B.300d.txt")
+    wordEmbedding = data_utils.load_vocabulary(
+        "datasets/glove/glove.6B.300d.txt", indexer_only=True
+    )
 
     model = BertPretrain(
         text_encoder="bert-base-uncased",
@@ -176,6 +254,8 @@ if __name__ == "__main__":
                 image_features_type=args.image_features_type,
                 word_embedding=wordEmbedding,
                 split="test",
+                cache_dir=args.cache_dir,
+                sense2vec_path=args.sense2vec,
             )
         )
     else:
@@ -185,6 +265,8 @@ if __name__ == "__main__":
                 image_features_type=args.image_features_type,
                 word_embedding=wordEmbedding,
                 split="val",
+                cache_dir=args.cache_dir,
+                sense2vec_path=args.sense2vec,
             )
         )
 
@@ -196,6 +278,10 @@ if __name__ == "__main__":
             split="train",
             ssl=False,
             sentence_patch_sim=False,
+            cache_dir=args.cache_dir,
+            sense2vec_path=args.sense2vec,
+            pad_to_max=not args.dynamic_padding,
+            return_phrases=False,
         )
     )
     ssl_dset = localized_narratives_pretrain_loader.LocalizedNarrativesFlickr30dataset(
@@ -205,6 +291,10 @@ if __name__ == "__main__":
         split="train",
         ssl=True,
         sentence_patch_sim=False,
+        cache_dir=args.cache_dir,
+        sense2vec_path=args.sense2vec,
+        pad_to_max=not args.dynamic_padding,
+        return_phrases=False,
     )
 
     if args.distributed:
@@ -231,25 +321,77 @@ if __name__ == "__main__":
         drop_last=True,
         sampler=test_sampler,
         shuffle=False,
+        # a cached test set keeps the compact dtypes and is finished per batch
+        collate_fn=(
+            batching.collate_eval
+            if args.eval_cache == "none"
+            else batching.collate_dynamic
+        ),
     )
 
-    train_loader = DataLoader(
-        train_dset,
-        batch_size=args.batch,
-        num_workers=0,
-        drop_last=True,
-        sampler=train_sampler,
-        shuffle=False,
-    )
+    if args.eval_cache != "none":
+        test_loader = eval_cache.CachedEvalSet.from_loader(
+            test_loader,
+            device=device if args.eval_cache == "device" else None,
+            pin_memory=args.eval_cache == "pinned",
+        )
 
-    ssl_loader = DataLoader(
-        ssl_dset,
-        batch_size=args.batch,
-        num_workers=0,
-        drop_last=True,
-        sampler=ssl_sampler,
-        shuffle=False,
+    loader_kwargs = dict(
+        num_workers=args.num_workers,
+        collate_fn=batching.Batch.collate,
+        pin_memory=device.type == "cuda",
+        persistent_workers=args.num_workers > 0,
     )
+    if args.dynamic_padding:
+        train_loader = DataLoader(
+            train_dset,
+            batch_sampler=batching.BucketBatchSampler(
+                train_dset.caption_lengths(),
+                args.batch,
+                drop_last=True,
+                bucket_size=args.bucket_size,
+                num_replicas=get_world_size(),
+                rank=get_rank(),
+                seed=args.seed,
+            ),
+            **loader_kwargs,
+        )
+
+        ssl_loader = DataLoader(
+            ssl_dset,
+            batch_sampler=batching.BucketBatchSampler(
+                ssl_dset.caption_lengths(),
+                args.batch,
+                drop_last=True,
+                bucket_size=args.bucket_size,
+                num_replicas=get_world_size(),
+                rank=get_rank(),
+                seed=args.seed,
+            ),
+            **loader_kwargs,
+        )
+    else:
+        train_loader = DataLoader(
+            train_dset,
+            batch_size=args.batch,
+            drop_last=True,
+            sampler=train_sampler,
+            shuffle=False,
+            **loader_kwargs,
+        )
+
+        ssl_loader = DataLoader(
+            ssl_dset,
+            batch_size=args.batch,
+            drop_last=True,
+            sampler=ssl_sampler,
+            shuffle=False,
+            **loader_kwargs,
+        )
+
+    if args.prefetch > 0:
+        train_loader = prefetch.PrefetchLoader(train_loader, device, args.prefetch)
+        ssl_loader = prefetch.PrefetchLoader(ssl_loader, device, args.prefetch)
 
     train_model(
         model,
@@ -22,6 +22,23 @@ def fro_norm(x1, x2):
     return fro_loss
 
 
+def query_mask(num_query, size):
+    return torch.arange(size, device=num_query.device)[None, :] < num_query[:, None]
+
+
+def masked_mean(values, mask, dim=None):
+    mask = mask.to(values.dtype)
+    if dim is None:
+        return (values * mask).sum() / mask.sum().clamp(min=1)
+    return (values * mask).sum(dim) / mask.sum(dim).clamp(min=1)
+
+
+def batched_fro_norm(x1, x2):
+    diff = x1 - x2
+    fro_loss = torch.linalg.norm(diff, dim=-1).mean(dim=-1)
+    return fro_loss
+
+
 def fro_norm_pos(x1, x2):
     pos_mask = (x2 > 0.0).float()
     diff = x1 - x2
@@ -85,6 +102,19 @@ class SmoothLoss(nn.Module):
         losses = torch.relu(distance_positive - distance_negative + self.margin)
         return losses.mean()
 
+    def forward_batched(self, embeddings, num_query, positive=None, negative=None):
+        mask = query_mask(num_query, embeddings.size(1))
+        if positive is None:
+            positive = masked_mean(embeddings, mask[:, :, None], dim=1)
+        if negative is None:
+            negative = masked_mean(
+                embeddings.logical_not().to(embeddings.dtype), mask[:, :, None], dim=1
+            )
+        distance_positive = torch.norm(embeddings - positive[:, None, :], dim=-1)
+        distance_negative = torch.norm(embeddings - negative[:, None, :], dim=-1)
+        losses = torch.relu(distance_positive - distance_negative + self.margin)
+        return masked_mean(losses, mask, dim=1)
+
 
 
 
@@ -102,6 +132,22 @@ def bce_loss(features, target):
     return loss.mean()
 
 
+def batched_bce_loss(features, target, num_query):
+    features = F.normalize(features, p=2.0, dim=-1)
+    input = torch.bmm(features, features.transpose(1, 2))
+    target = target[:, : input.size(1), : input.size(2)]
+    max_val = (-input).clamp(min=0)
+    loss = (
+        input
+        - input * target
+        + max_val
+        + ((-max_val).exp() + (-input - max_val).exp()).log()
+    )
+    mask = query_mask(num_query, input.size(1))
+    pair_mask = mask[:, :, None] & mask[:, None, :]
+    return masked_mean(loss, pair_mask, dim=(1, 2))
+
+
 def ce_loss(pred, target):
 
     loss = -(target * (pred + 1e-9).log()).mean()
@@ -110,6 +156,11 @@ def ce_loss(pred, target):
 
 
 
+def batched_ce_loss(pred, target, mask):
+    loss = -(target * (pred + 1e-9).log())
+    return masked_mean(loss, mask, dim=(1, 2))
+
+
 def smooth_loss1(pred, target, smoothing=0.1):
 
     smooth_target = torch.full_like(pred, smoothing / (pred.size(1) - 1))
@@ -172,3 +223,58 @@ class SupContrastiveLoss(nn.Module):
         )
 
         return (-mean_log_prob_pos).mean()
+
+    def forward_batched(self, features, labels, num_query):
+        features = F.normalize(features, p=2.0, dim=-1)
+        mat = torch.bmm(features, features.transpose(1, 2))
+        labels = labels[:, : mat.size(1), : mat.size(2)]
+        mask = query_mask(num_query, mat.size(1))
+        pair_mask = mask[:, :, None] & mask[:, None, :]
+
+        pos_mask = labels.eq(1) & pair_mask
+        neg_mask = labels.eq(0) & pair_mask
+        mat = mat / self.temperature
+        mat_max, _ = mat.masked_fill(~pair_mask, self.neg_inf(mat.dtype)).max(
+            dim=-1, keepdim=True
+        )
+        mat = mat - mat_max.detach()
+
+        denominator = self.logsumexp(
+            mat, keep_mask=pos_mask | neg_mask, add_one=False, dim=-1
+        )
+        log_prob = mat - denominator
+        pos_mask = pos_mask.to(mat.dtype)
+        mean_log_prob_pos = (pos_mask * log_prob).sum(dim=-1) / (
+            pos_mask.sum(dim=-1) + self.small_val(mat.dtype)
+        )
+
+        return masked_mean(-mean_log_prob_pos, mask, dim=1)
+
+
+def grounding_pseudo_label_loss(
+    grounding_matrix, teacher_grounding_matrix, num_query, threshold=0.01, smoothing=0.1
+):
+    teacher_grounding_matrix = teacher_grounding_matrix.float()
+    maxval, _ = teacher_grounding_matrix.max(dim=-1, keepdim=True)
+    target = (teacher_grounding_matrix == maxval).to(grounding_matrix.dtype)
+    row_mask = query_mask(num_query, grounding_matrix.size(1)) & (
+        maxval.squeeze(-1) > threshold
+    )
+    num_rows = row_mask.sum(dim=1)
+    sample_mask = num_rows > 0
+
+    ce = -(target * (grounding_matrix + 1e-9).log()).mean(dim=-1)
+    ce = masked_mean(ce, row_mask, dim=1)
+
+    num_classes = grounding_matrix.size(-1)
+    smooth_target = target * (1 - smoothing) + (1 - target) * (
+        smoothing / (num_classes - 1)
+    )
+    smooth = -(smooth_target * grounding_matrix.log()).sum(dim=-1)
+    smooth = smooth.masked_fill(~row_mask, 0.0).sum(dim=1) / num_rows.clamp(min=1)
+    smooth_mask = sample_mask & torch.isfinite(smooth)
+
+    return (
+        masked_mean(ce, sample_mask),
+        masked_mean(smooth.masked_fill(~smooth_mask, 0.0), smooth_mask),
+    )
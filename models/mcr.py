@@ -152,45 +152,113 @@ class BertPretrain(nn.Module):
             )
             self.bbox_transform = bbox_regression.Box2BoxTransform(self.weights)
 
-    def get_phrase_embeddings(self, q_start_ind, sentence_embedding, num_query):
-        batch_len = q_start_ind.size(0)
-        phrase_word_embs = torch.zeros(
-            q_start_ind.size(0),
-            self.max_num_queries,
-            self.max_phrase_length,
-            sentence_embedding.shape[-1],
-        ).cuda()
-        phrase_mask = (
-            torch.zeros(
-                q_start_ind.size(0), self.max_num_queries, self.max_phrase_length
+        self._label_cache_version = None
+        self._label_cache_index = {}
+        self._label_cache_embeds = None
+
+    def _label_encoder_version(self):
+        return sum(p._version for p in self.text_encoder.bert.parameters())
+
+    def _encode_labels(self, input_ids, attention_mask):
+        label_output = self.text_encoder.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            return_dict=True,
+            mode="text",
+        )
+        return torch.mean(label_output.last_hidden_state, dim=-2)
+
+    def _cached_label_embeddings(self, label_rows, label_width):
+        version = self._label_encoder_version()
+        if version != self._label_cache_version:
+            self._label_cache_version = version
+            self._label_cache_index = {}
+            self._label_cache_embeds = None
+
+        keys = [tuple(row) for row in label_rows.tolist()]
+        missing = [i for i, key in enumerate(keys) if key not in self._label_cache_index]
+        if len(missing) > 0:
+            missing_rows = label_rows[missing]
+            with torch.no_grad():
+                new_embeds = self._encode_labels(
+                    missing_rows[:, :label_width], missing_rows[:, label_width:]
+                )
+            offset = 0 if self._label_cache_embeds is None else len(self._label_cache_embeds)
+            for n, i in enumerate(missing):
+                self._label_cache_index[keys[i]] = offset + n
+            if self._label_cache_embeds is None:
+                self._label_cache_embeds = new_embeds
+            else:
+                self._label_cache_embeds = torch.cat(
+                    (self._label_cache_embeds, new_embeds)
+                )
+        rows = torch.tensor(
+            [self._label_cache_index[key] for key in keys], device=label_rows.device
+        )
+        return self._label_cache_embeds[rows]
+
+    def encode_object_labels(self, object_label_input_ids, object_label_attention_mask):
+        label_width = object_label_input_ids.shape[-1]
+        label_rows, inverse = torch.unique(
+            torch.cat((object_label_input_ids, object_label_attention_mask), dim=-1),
+            dim=0,
+            return_inverse=True,
+        )
+        encoder_frozen = not any(
+            p.requires_grad for p in self.text_encoder.bert.parameters()
+        )
+        if not self.training or encoder_frozen:
+            label_embeds = self._cached_label_embeddings(label_rows, label_width)
+        else:
+            label_embeds = self._encode_labels(
+                label_rows[:, :label_width], label_rows[:, label_width:]
             )
-            .cuda()
-            .float()
+        return label_embeds[inverse]
+
+    def _phrase_spans(self, q_start_ind, num_query):
+        start = q_start_ind[..., 0]
+        phr_len = q_start_ind[..., 1] - start + 1
+        query_ids = torch.arange(q_start_ind.size(1), device=q_start_ind.device)
+        valid = (
+            (query_ids[None, :] < num_query[:, None])
+            & (phr_len > 0)
+            & (phr_len <= self.max_phrase_length)
         )
+        return start, phr_len, valid
 
-        for batch in range(batch_len):
-            num_queries = num_query[batch]
+    def get_phrase_embeddings(self, q_start_ind, sentence_embedding, num_query):
+        batch_len, num_queries = q_start_ind.shape[:2]
+        seq_len, dim = sentence_embedding.shape[1:]
+        start, phr_len, valid = self._phrase_spans(q_start_ind, num_query)
 
-            for n_q in range(int(num_queries)):
-                phr_len = (
-                    int((q_start_ind[batch][n_q][1]))
-                    - int((q_start_ind[batch][n_q][0]))
-                    + 1
-                )
-                start_ind = int(q_start_ind[batch][n_q][0])
-                end_ind = int(q_start_ind[batch][n_q][1])
-                if phr_len <= self.max_phrase_length:
-                    phrase_word_embs[batch, n_q, :phr_len, :] += sentence_embedding[
-                        batch
-                    ][start_ind : end_ind + 1]
-                    phrase_mask[batch, n_q, :phr_len] = 1.0
-                else:
-                    print("skipping. phrase length of {} too long".format(phr_len))
-
-        phrase_word_embs = phrase_word_embs * phrase_mask[:, :, :, None]
+        offsets = torch.arange(self.max_phrase_length, device=q_start_ind.device)
+        positions = start[..., None] + offsets
+        phrase_mask = (
+            valid[..., None] & (offsets < phr_len[..., None]) & (positions < seq_len)
+        )
+        positions = positions.clamp(max=seq_len - 1).view(batch_len, -1, 1)
+        phrase_word_embs = torch.gather(
+            sentence_embedding, 1, positions.expand(-1, -1, dim)
+        ).view(batch_len, num_queries, self.max_phrase_length, dim)
+
+        phrase_word_embs = phrase_word_embs * phrase_mask[:, :, :, None].to(
+            phrase_word_embs.dtype
+        )
 
         return phrase_word_embs
 
+    # same result as get_phrase_embeddings(...).mean(dim=-2), computed as a
+    # (B x Q x L) span-weight matmul so the B x Q x P x D tensor is never built
+    def get_phrase_mean_embeddings(self, q_start_ind, sentence_embedding, num_query):
+        start, phr_len, valid = self._phrase_spans(q_start_ind, num_query)
+        tokens = torch.arange(sentence_embedding.size(1), device=q_start_ind.device)
+        span_weights = (
+            valid[..., None]
+            & (tokens >= start[..., None])
+            & (tokens < (start + phr_len)[..., None])
+        ).to(sentence_embedding.dtype) / self.max_phrase_length
+        return torch.bmm(span_weights, sentence_embedding)
+
     def cosine_similarity_matrix(self, matrix):
         norm = torch.norm(matrix, p=2, dim=-1, keepdim=True)
         matrix = matrix / norm
@@ -240,6 +308,37 @@ class BertPretrain(nn.Module):
 
 
 
+    def mlm_loss(self, text_input_ids, text_attention_mask, alpha=0):
+        input_ids = text_input_ids.clone()
+        labels = input_ids.clone()
+
+        probability_matrix = torch.full(labels.shape, self.mlm_probability)
+
+        input_ids, labels = self.random_mask(
+            input_ids,
+            self.text_encoder.config.vocab_size,
+            text_input_ids.device,
+            targets=labels,
+            probability_matrix=probability_matrix,
+        )
+        mlm_output = self.text_encoder(
+            input_ids,
+            attention_mask=text_attention_mask,
+            return_dict=True,
+            labels=labels,
+            mode="text",
+            alpha=alpha,
+        )
+        return mlm_output.loss
+
+    def _length_mask(self, lengths, size):
+        return torch.arange(size, device=lengths.device)[None, :] < lengths[:, None]
+
+    def _match_length(self, x, length):
+        if x.shape[1] >= length:
+            return x[:, :length]
+        return F.pad(x, (0, 0, 0, length - x.shape[1]))
+
     def _product_of_experts(self, text_mu, text_logvar, img_mu, img_logvar):
         fusion_mu = (
                             text_mu * torch.exp(img_logvar) + img_mu * torch.exp(text_logvar)
@@ -269,7 +368,10 @@ class BertPretrain(nn.Module):
         max_assignments=None,
         train=False,
         alpha=0,
+        inference=None,
     ):
+        if inference is None:
+            inference = not torch.is_grad_enabled()
         text_output = self.text_encoder.bert(
             text_input_ids,
             attention_mask=text_attention_mask,
@@ -277,27 +379,10 @@ class BertPretrain(nn.Module):
             mode="text",
         )
         text_embeds = text_output.last_hidden_state
-        input_ids = text_input_ids.clone()
-        labels = input_ids.clone()
-
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
-
-        input_ids, labels = self.random_mask(
-            input_ids,
-            self.text_encoder.config.vocab_size,
-            text_input_ids.device,
-            targets=labels,
-            probability_matrix=probability_matrix,
-        )
-        mlm_output = self.text_encoder(
-            input_ids,
-            attention_mask=text_attention_mask,
-            return_dict=True,
-            labels=labels,
-            mode="text",
-            alpha=alpha,
-        )
-        loss_mlm = mlm_output.loss
+        if inference:
+            loss_mlm = text_embeds.new_zeros(())
+        else:
+            loss_mlm = self.mlm_loss(text_input_ids, text_attention_mask, alpha=alpha)
 
         if self.s2v:
             text_embeds = self.new_text_proj(
@@ -306,19 +391,13 @@ class BertPretrain(nn.Module):
         else:
             text_embeds = self.new_text_proj(text_embeds)
 
-        phrase_embeddings = self.get_phrase_embeddings(
+        phrase_embeddings = self.get_phrase_mean_embeddings(
             q_start_ind, text_embeds, num_query
         )
 
-        object_label_output = self.text_encoder.bert(
-            object_label_input_ids,
-            attention_mask=object_label_attention_mask,
-            return_dict=True,
-            mode="text",
+        object_label_embeds = self.encode_object_labels(
+            object_label_input_ids, object_label_attention_mask
         )
-
-        object_label_embeds = object_label_output.last_hidden_state
-        object_label_embeds = torch.mean(object_label_embeds, dim=-2)
         object_label_embeds = object_label_embeds.view(
             image_features.shape[0], image_features.shape[1], -1
         )
@@ -327,25 +406,13 @@ class BertPretrain(nn.Module):
             image_features, object_regions, object_label_embeds
         )
 
-        image_mask = torch.zeros(image_embeds.shape[0], image_embeds.shape[1]).cuda()
-        for b in range(len(image_mask)):
-            image_mask[b, : int(num_objects[b])] = 1
+        image_mask = self._length_mask(num_objects, image_embeds.shape[1]).float()
         mm_image_attention_mask = image_mask
 
-        query_mask = torch.zeros(
-            phrase_embeddings.shape[0], phrase_embeddings.shape[1]
-        ).cuda()
-        for b in range(len(query_mask)):
-            query_mask[b, : int(num_query[b])] = 1
+        query_mask = self._length_mask(num_query, phrase_embeddings.shape[1]).float()
         query_attention_mask = query_mask
-        image_mask = torch.zeros(image_embeds.shape[0], image_embeds.shape[1]).cuda()
-        for b in range(len(image_mask)):
-            image_mask[b, : int(num_objects[b])] = 1
-        image_attention_mask = image_mask.unsqueeze(1).unsqueeze(-1)
-        image_attention_mask = image_attention_mask.repeat(
-            1, self.config["num_attention_heads"], 1, image_mask.shape[-1]
-        )
-        image_attention_mask = image_attention_mask.to(
+        # B x 1 x N x 1, broadcast over heads and keys in BertSelfAttention
+        image_attention_mask = image_mask[:, None, :, None].to(
             dtype=next(self.parameters()).dtype
         )
         image_attention_mask = (1.0 - image_attention_mask) * -10000.0
@@ -356,7 +423,6 @@ class BertPretrain(nn.Module):
         )
         image_encoding = image_encoding[-1]
 
-        phrase_embeddings = torch.mean(phrase_embeddings, dim=-2)
         if self.adaptor_layers:
             phrase_embeddings = self.linear_phrase_adaptor(phrase_embeddings)
 
@@ -365,10 +431,20 @@ class BertPretrain(nn.Module):
         img_mu = self.fc_img_mu(image_encoding)
         img_logvar = self.fc_img_logvar(image_encoding)
 
-        fusion_mu, fusion_logvar = self._product_of_experts(txt_mu, txt_logvar, img_mu, img_logvar)
-        fusion_feature = fusion_mu + torch.exp(fusion_logvar / 2) * torch.randn((8, 128, 768)).cuda()
-        sampled_normal = torch.randn(8, 128, 768).cuda()
-        sampling_z4txt = txt_mu + torch.exp(txt_logvar / 2)* sampled_normal
+        num_queries = phrase_embeddings.shape[1]
+        num_regions = image_encoding.shape[1]
+        fusion_mu, fusion_logvar = self._product_of_experts(
+            txt_mu,
+            txt_logvar,
+            self._match_length(img_mu, num_queries),
+            self._match_length(img_logvar, num_queries),
+        )
+        fusion_feature = fusion_mu + torch.exp(fusion_logvar / 2) * torch.randn_like(fusion_mu)
+        sampled_normal = torch.randn(
+            txt_mu.shape[0], max(num_queries, num_regions), txt_mu.shape[-1],
+            device=txt_mu.device,
+        )
+        sampling_z4txt = txt_mu + torch.exp(txt_logvar / 2)* sampled_normal[:, :num_queries]
         recon_span_feature_l = self.decoder(sampling_z4txt)
 
         recon_loss_l4txt = F.mse_loss(phrase_embeddings, recon_span_feature_l)
@@ -376,7 +452,7 @@ class BertPretrain(nn.Module):
             1.0 + txt_logvar - torch.square(txt_mu) - torch.exp(txt_logvar), dim=-1
         )
 
-        sampling_z4img = img_mu + torch.exp(img_logvar / 2) * sampled_normal
+        sampling_z4img = img_mu + torch.exp(img_logvar / 2) * sampled_normal[:, :num_regions]
         recon_img_feature_l = self.decoder(sampling_z4img)
 
         recon_loss_l4img = F.mse_loss(image_encoding, recon_img_feature_l)
@@ -412,7 +488,6 @@ class BertPretrain(nn.Module):
         grounding_matrix = output_pos.cross_attentions[-1][
             :, -1, :, :
         ]
-        grounding_matrix = grounding_matrix.view(-1, self.max_num_queries, 128)
 
         maxatt, _ = attmap.max(dim=-1)
         logits = torch.sum(maxatt, dim=-1).div(
@@ -424,10 +499,8 @@ class BertPretrain(nn.Module):
 
         maxval, _ = i_att.max(dim=2, keepdim=True)
         predictions = i_att == maxval
-        query_mask = torch.zeros(image_encoding.shape[0], self.max_num_queries).cuda()
-        query_mask_reg = torch.zeros(
-            image_encoding.shape[0], self.max_num_queries, self.max_num_queries
-        ).cuda()
+        query_mask = self._length_mask(num_query, num_queries).float()
+        query_mask_reg = query_mask[:, :, None] * query_mask[:, None, :]
         if self.adaptor_layers:
             weighted_phrase_embedding = self.linear_multimodal_adaptor(
                 output_pos.last_hidden_state
@@ -435,7 +508,7 @@ class BertPretrain(nn.Module):
         else:
             weighted_phrase_embedding = output_pos.last_hidden_state
         weighted_phrase_embedding = weighted_phrase_embedding.view(
-            -1, self.max_num_queries, weighted_phrase_embedding.shape[-1]
+            -1, num_queries, weighted_phrase_embedding.shape[-1]
         )
         weighted_phrase_embedding = weighted_phrase_embedding + fusion_feature
 
@@ -460,31 +533,18 @@ class BertPretrain(nn.Module):
             predictions = self.get_hungarian_assignment(i_att, max_assignments)
         else:
             predictions = i_att == maxval
-        for b in range(len(query_mask_reg)):
-            query_mask[b, : int(num_query[b])] = 1.0
-            query_mask_reg[b, : int(num_query[b]), : int(num_query[b])] = 1.0
         matrix_logits_reg = torch.matmul(
             predictions.float(), predictions.permute(0, 2, 1).float()
         )
         matrix_logits_reg = pred_coref_matrix * query_mask_reg
 
-        pred_bboxes = []
-        for i in range(predictions.size(0)):
-            select_box = (
-                object_regions[i]
-                .unsqueeze(0)
-                .expand(predictions.size(1), predictions.size(2), 5)
-                .long()
-            )
-            select_mask = predictions[i].unsqueeze(-1).long()
-
-            avail_box = select_box * select_mask
-            _, maxidx = avail_box.max(dim=1)
-            bbox = select_box[torch.arange(select_box.size(0)), maxidx[:, -1]]
-            pred_bboxes.append(bbox[:, :4])
-
-       
-        pred_bboxes = torch.stack(pred_bboxes)
+        # per query, the selected region with the largest area
+        regions = object_regions.long()
+        avail_area = regions[:, None, :, 4] * predictions.long()
+        _, maxidx = avail_area.max(dim=-1)
+        pred_bboxes = torch.gather(
+            regions[:, :, :4], 1, maxidx.unsqueeze(-1).expand(-1, -1, 4)
+        )
         if self.bbox_reg:
             pred_bbox_deltas = self.bbox_reg_fc(weighted_phrase_embedding)
 
@@ -0,0 +1,49 @@
+import torch
+
+
+class TeacherCache(object):
+    """Label propagation targets of the EMA model, cached per image.
+
+    The EMA weights move slowly, so its grounding and coref outputs for an
+    image are reused for refresh_epochs epochs. lookup returns None when any
+    image of the batch has no target that recent; the caller then runs the
+    EMA model on the batch and stores the result. Targets are kept on the
+    host in float16, trimmed to (num_query, num_objects).
+    """
+
+    def __init__(self, refresh_epochs=2, dtype=torch.float16):
+        self.refresh_epochs = refresh_epochs
+        self.dtype = dtype
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, image_ids, epoch, num_queries, num_regions, device):
+        entries = [self._entries.get(key) for key in image_ids.tolist()]
+        if any(
+            entry is None or epoch - entry[0] >= self.refresh_epochs
+            for entry in entries
+        ):
+            return None
+        grounding = torch.zeros(
+            (len(entries), num_queries, num_regions), dtype=self.dtype
+        )
+        coref = torch.zeros((len(entries), num_queries, num_queries), dtype=self.dtype)
+        for i, (_, sample_grounding, sample_coref) in enumerate(entries):
+            q, o = sample_grounding.shape
+            grounding[i, :q, :o] = sample_grounding
+            coref[i, :q, :q] = sample_coref
+        return grounding.to(device).float(), coref.to(device).float()
+
+    def store(self, image_ids, epoch, grounding, coref, num_query, num_objects):
+        grounding = grounding.detach().to("cpu", self.dtype)
+        coref = coref.detach().to("cpu", self.dtype)
+        for i, (key, q, o) in enumerate(
+            zip(image_ids.tolist(), num_query.tolist(), num_objects.tolist())
+        ):
+            self._entries[key] = (
+                epoch,
+                grounding[i, :q, :o].clone(),
+                coref[i, :q, :q].clone(),
+            )
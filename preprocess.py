@@ -0,0 +1,108 @@
+import argparse
+
+from tqdm import tqdm
+
+from data import localized_narratives_pretrain_loader
+from data import data_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, default="datasets/")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="datasets/preprocessed",
+        help="output directory for the per-image text cache",
+    )
+    parser.add_argument(
+        "--image_features_type",
+        type=str,
+        default="faster_rcnn",
+        help="use faster rcnn features",
+    )
+    parser.add_argument(
+        "--glove", type=str, default="datasets/glove/glove.6B.300d.txt"
+    )
+    parser.add_argument(
+        "--sense2vec", type=str, default=None, help="sense2vec vectors directory"
+    )
+    parser.add_argument(
+        "--s2v-float16",
+        action="store_true",
+        help="store the cached sense2vec features as float16",
+    )
+    parser.add_argument(
+        "--splits", nargs="+", default=["train", "val", "test"], help="splits to cache"
+    )
+    parser.add_argument(
+        "--eval-grounding",
+        action="store_true",
+        help="also cache the grounding variant of the val/test splits",
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=1000, help="images parsed per nlp.pipe call"
+    )
+    parser.add_argument(
+        "--n-process", type=int, default=1, help="spaCy worker processes"
+    )
+    parser.add_argument(
+        "--parse-batch-size", type=int, default=64, help="spaCy nlp.pipe batch size"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="rebuild existing cache entries"
+    )
+    args = parser.parse_args()
+    return args
+
+
+def build_datasets(args, split, word_embedding):
+    dsets = []
+    if split == "train":
+        for ssl in (False, True):
+            dsets.append(
+                localized_narratives_pretrain_loader.LocalizedNarrativesFlickr30dataset(
+                    dataroot=args.dataroot,
+                    image_features_type=args.image_features_type,
+                    word_embedding=word_embedding,
+                    split=split,
+                    ssl=ssl,
+                    cache_dir=args.cache_dir,
+                    sense2vec_path=args.sense2vec,
+                    s2v_float16=args.s2v_float16,
+                )
+            )
+    else:
+        eval_grounding_modes = [False, True] if args.eval_grounding else [False]
+        for eval_grounding in eval_grounding_modes:
+            dsets.append(
+                localized_narratives_pretrain_loader.LocalizedNarrativesFlickr30dataset(
+                    dataroot=args.dataroot,
+                    image_features_type=args.image_features_type,
+                    word_embedding=word_embedding,
+                    split=split,
+                    eval_grounding=eval_grounding,
+                    cache_dir=args.cache_dir,
+                    sense2vec_path=args.sense2vec,
+                    s2v_float16=args.s2v_float16,
+                )
+            )
+    return dsets
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+
+    wordEmbedding = data_utils.load_vocabulary(args.glove, indexer_only=True)
+
+    for split in args.splits:
+        for dset in build_datasets(args, split, wordEmbedding):
+            for start in tqdm(range(0, len(dset), args.shard_size), desc=split):
+                dset.write_text_cache_shard(
+                    range(start, min(start + args.shard_size, len(dset))),
+                    overwrite=args.overwrite,
+                    n_process=args.n_process,
+                    batch_size=args.parse_batch_size,
+                )
+            dset.write_length_index()
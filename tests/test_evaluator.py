@@ -0,0 +1,24 @@
+from utils.evaluator import Evaluator
+
+
+def test_perclass_accuracy_counts_repeated_category_once():
+    evaluator = Evaluator()
+    iouList = [1.0, 0.0]
+    boxCategoriesList = [["people", "people", "clothing"], ["people"]]
+
+    perClassAccDict = evaluator.perclass_accuracy(iouList, boxCategoriesList)
+
+    assert perClassAccDict == {"clothing": 1.0, "people": 0.5}
+
+
+def test_streaming_matches_full_evaluation():
+    predicted = [[0, 0, 10, 10], [0, 0, 4, 4], [5, 5, 9, 9]]
+    gt = [[0, 0, 10, 10], [0, 0, 10, 10], [5, 5, 9, 9]]
+    categories = [["people"], ["people", "people"], ["animals"]]
+
+    evaluator = Evaluator()
+    evaluator.update(predicted[:2], gt[:2], categories[:2])
+    evaluator.update(predicted[2:], gt[2:], categories[2:])
+
+    full = evaluator.evaluate_perclass(predicted, gt, categories)
+    assert evaluator.summarize()[:2] == full[:2]
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from data import batching
+from data.prefetch import PrefetchLoader
+
+
+def make_sample(num_query=3, num_objects=4, caption_length=8):
+    return batching.compact_sample(
+        (
+            torch.tensor(1),
+            ["phrase"] * num_query,
+            torch.randn(num_objects, 2048),
+            torch.randint(0, 100, (num_objects, 1, 16)),
+            torch.ones(num_objects, 1, 16, dtype=torch.bool),
+            torch.rand(num_objects, 5),
+            torch.randint(0, 100, (num_query, 1, 16)),
+            torch.ones(num_query, 1, 16, dtype=torch.bool),
+            torch.randint(0, 100, (1, caption_length)),
+            torch.ones(1, caption_length, dtype=torch.bool),
+            torch.randn(caption_length, 128),
+            torch.randint(0, caption_length, (num_query, 2)),
+            torch.tensor(num_objects),
+            torch.tensor(num_query),
+            torch.rand(num_query, 1, 4),
+            torch.tensor([]),
+            torch.arange(num_query) % 2,
+            torch.zeros(num_query, num_query, dtype=torch.uint8),
+        )
+    )
+
+
+def make_loader(num_batches=3, batch_size=2):
+    return [
+        batching.Batch.collate([make_sample() for _ in range(batch_size)])
+        for _ in range(num_batches)
+    ]
+
+
+def test_prefetch_cpu():
+    loader = PrefetchLoader(make_loader(), "cpu")
+    batches = list(loader)
+    assert len(batches) == 3
+    assert batches[0].image_features.dtype == torch.float32
+    assert loader.stats.summary()["batches"] == 3
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_prefetch_cuda_without_index():
+    loader = PrefetchLoader(make_loader(), torch.device("cuda"))
+    batches = list(loader)
+    assert len(batches) == 3
+    for batch in batches:
+        for tensor in batch.tensors().values():
+            assert tensor.is_cuda
+    torch.cuda.synchronize()
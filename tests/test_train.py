@@ -0,0 +1,101 @@
+import ast
+import inspect
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from data import batching
+from test_prefetch import make_sample
+from utils.utils import AttrDict
+
+# train imports the evaluation and scheduler packages of the full setup
+train = pytest.importorskip("train")
+
+MCR_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "models", "mcr.py")
+
+
+def forward_signature():
+    """Signature of BertPretrain.forward, read from its source.
+
+    models.mcr needs the text encoder stack to import; the parameter list is
+    all the training loop has to agree with.
+    """
+    with open(MCR_PATH) as f:
+        tree = ast.parse(f.read())
+    cls = next(
+        node
+        for node in tree.body
+        if isinstance(node, ast.ClassDef) and node.name == "BertPretrain"
+    )
+    forward = next(
+        node
+        for node in cls.body
+        if isinstance(node, ast.FunctionDef) and node.name == "forward"
+    )
+    args = forward.args.args
+    num_required = len(args) - len(forward.args.defaults)
+    return inspect.Signature(
+        [
+            inspect.Parameter(
+                arg.arg,
+                inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                default=inspect.Parameter.empty if i < num_required else None,
+            )
+            for i, arg in enumerate(args)
+        ]
+    )
+
+
+class TinyPretrain(nn.Module):
+    """Binds its inputs to BertPretrain.forward and returns its 15 outputs."""
+
+    signature = forward_signature()
+
+    def __init__(self, dim=8):
+        super().__init__()
+        self.region_proj = nn.Linear(2048, dim)
+        self.classifier = nn.Linear(dim, 2)
+
+    def forward(self, *args, **kwargs):
+        inputs = self.signature.bind(self, *args, **kwargs).arguments
+        regions = self.region_proj(inputs["image_features"])
+        num_queries = inputs["q_start_ind"].size(1)
+        phrases = regions.mean(1, keepdim=True).expand(-1, num_queries, -1)
+        grounding = F.softmax(torch.matmul(phrases, regions.transpose(1, 2)), -1)
+        coref = torch.matmul(phrases, phrases.transpose(1, 2))
+        probs = self.classifier(regions.mean(1))
+        loss_mlm = regions.pow(2).mean()
+        bboxes = regions.new_zeros(regions.size(0) * num_queries, 4)
+        return (
+            loss_mlm,
+            loss_mlm.new_zeros(()),
+            grounding,
+            coref,
+            phrases,
+            regions,
+            phrases,
+            None,
+            torch.ones_like(probs),
+            probs,
+            None,
+            None,
+            None,
+            None,
+            bboxes,
+        )
+
+
+def test_ssl_train_step():
+    model = TinyPretrain()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    batch = batching.Batch.collate([make_sample(), make_sample(num_query=2)])
+    args = AttrDict(ssl_loss="fro", bbox_reg=False, grounding=True)
+
+    loss = train.ssl_train(model, batch, torch.device("cpu"), optimizer, args)
+    loss.backward()
+
+    assert torch.isfinite(loss)
+    assert model.region_proj.weight.grad is not None
@@ -8,7 +8,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
 
+from data import dual_loader
+from data import eval_cache
 from models import losses
+from models import pseudo_label
 from utils import utils
 from utils.evaluator import Evaluator
 from utils.utils import union_target, AttrDict
@@ -30,7 +33,7 @@ smooth_loss_unlabeled = losses.SmoothLoss(margin=1.0)
 
 
 class AdaptiveThreshold:
-    def __init__(self, decay=, initial_threshold=):
+    def __init__(self, decay=0.5, initial_threshold=0.9):
         self.decay = decay
         self.threshold = initial_threshold
 
@@ -41,82 +44,33 @@ class AdaptiveThreshold:
         return self.threshold
 
 
-def ssl_train(model, ssl_loader, ssl_train_iter, device, optimizer, args, lr=):
-    use_gpu = torch.cuda.is_available()
+def ssl_train(model, batch, device, optimizer, args, lr=1e-4):
     model = model.float()
     total_loss = 0
     n_batches = 0
 
-    (
-        image_id,
-        _,
-        image_features,
-        object_label_input_ids,
-        object_label_attention_mask,
-        object_regions,
-        phrase_queries_input_ids,
-        phrase_queries_attention_mask,
-        caption_input_ids,
-        caption_attn_masks,
-        sense2vec_feats,
-        query_start_end,
-        num_objects,
-        num_query,
-        target_bboxes,
-        mouse_trace_for_phrases,
-        mouse_trace_feats,
-        gt_coref_matrix,
-        _,
-    ) = next(ssl_train_iter)
-    if use_gpu:
-        (
-            image_features,
-            object_label_input_ids,
-            object_label_attention_mask,
-            object_regions,
-            phrase_queries_input_ids,
-            phrase_queries_attention_mask,
-            caption_input_ids,
-            caption_attn_masks,
-            sense2vec_feats,
-            query_start_end,
-            num_objects,
-            num_query,
-            target_bboxes,
-            mouse_trace_for_phrases,
-            mouse_trace_feats,
-            gt_coref_matrix,
-        ) = (
-            image_features.to(device),
-            object_label_input_ids.to(device),
-            object_label_attention_mask.to(device),
-            object_regions.to(device),
-            phrase_queries_input_ids.to(device),
-            phrase_queries_attention_mask.to(device),
-            caption_input_ids.to(device),
-            caption_attn_masks.to(device),
-            sense2vec_feats.to(device),
-            query_start_end.to(device),
-            num_objects.to(device),
-            num_query.to(device),
-            target_bboxes.to(device),
-            mouse_trace_for_phrases.to(device),
-            mouse_trace_feats.to(device),
-            gt_coref_matrix.to(device),
-        )
+    batch = batch.to(device, non_blocking=True)
+    gt_coref_matrix = utils.coref_matrix(batch.gt_coref_clusters)
 
     n_batches += 1
-    
-    caption_input_ids = caption_input_ids.squeeze(1)
-    caption_attn_masks = caption_attn_masks.squeeze(1)
-    phrase_queries_input_ids = phrase_queries_input_ids.squeeze(2)
-    object_label_input_ids = object_label_input_ids.squeeze(-2)
-    object_label_attention_mask = object_label_attention_mask.squeeze(-2)
-    object_label_input_ids = object_label_input_ids.view(-1, 16)
-    object_label_attention_mask = object_label_attention_mask.view(-1, 16)
-    
+
+    image_features = batch.image_features
+    object_regions = batch.object_regions
+    sense2vec_feats = batch.sense2vec_feats
+    query_start_end = batch.query_start_end
+    num_objects = batch.num_objects
+    num_query = batch.num_query
+    target_bboxes = batch.target_bboxes
+    caption_input_ids = batch.caption_input_ids.squeeze(1)
+    caption_attn_masks = batch.caption_attn_mask.squeeze(1)
+    object_label_input_ids = batch.object_label_input_ids.squeeze(-2).view(-1, 16)
+    object_label_attention_mask = batch.object_label_attention_mask.squeeze(-2).view(
+        -1, 16
+    )
+
     (
         loss_mlm,
+        _,
         grounding_matrix,
         pred_coref_matrix,
         weighted_phrase_embedding,
@@ -141,37 +95,21 @@ def ssl_train(model, ssl_loader, ssl_train_iter, device, optimizer, args, lr=):
         query_start_end,
         num_objects,
         num_query,
-        mouse_trace_feats,
-        phrase_queries_input_ids=phrase_queries_input_ids,
         max_assignments=None,
         train=False,
     )
     target_pred = torch.argmax(target, dim=1)
     
     if args.ssl_loss == "fro":
-        batch_reg_loss = [
-            losses.fro_norm(pred_coref_matrix[b], gt_coref_matrix[b])
-            for b in range(len(gt_coref_matrix))
-        ]
-        reg_loss = torch.stack(batch_reg_loss).mean()
+        reg_loss = losses.batched_fro_norm(pred_coref_matrix, gt_coref_matrix).mean()
     elif args.ssl_loss == "sigmoid":
-        batch_reg_loss = [
-            losses.bce_loss(
-                weighted_phrase_embedding[b][: num_query[b], :],
-                gt_coref_matrix[b][: num_query[b], : num_query[b]],
-            )
-            for b in range(len(gt_coref_matrix))
-        ]
-        reg_loss = torch.stack(batch_reg_loss).mean()
+        reg_loss = losses.batched_bce_loss(
+            weighted_phrase_embedding, gt_coref_matrix, num_query
+        ).mean()
     else:
-        batch_reg_loss = [
-            sup_contrastive_loss(
-                weighted_phrase_embedding[b][: num_query[b], :],
-                gt_coref_matrix[b][: num_query[b], : num_query[b]],
-            )
-            for b in range(len(gt_coref_matrix))
-        ]
-        reg_loss = torch.stack(batch_reg_loss).mean()
+        reg_loss = sup_contrastive_loss.forward_batched(
+            weighted_phrase_embedding, gt_coref_matrix, num_query
+        ).mean()
 
     if args.bbox_reg:
         bbox_reg_loss = losses.smooth_l1_loss(
@@ -179,22 +117,22 @@ def ssl_train(model, ssl_loader, ssl_train_iter, device, optimizer, args, lr=):
         )
         ssl_loss = reg_loss + bbox_reg_loss + loss_mlm + ceLoss(probs, target_pred)
     if args.grounding:
+        # target boxes are padded on their own axis; align them to the queries
+        num_queries = grounding_matrix.size(1)
         target_bboxes = target_bboxes.squeeze(-2)
-        alignment_loss = []
-        for b in range(len(object_regions)):
-            gnd_alignment = utils.get_grounding_alignment(
-                target_bboxes[b][: num_query[b], :],
-                object_regions[b][: num_objects[b], :4],
-            )
-           
-            batch_alignment = (gnd_alignment).long().to(device)
-            alignment_loss.append(
-                losses.ce_loss(
-                    grounding_matrix[b][: num_query[b], : num_objects[b]],
-                    batch_alignment,
-                )
-            )
-        alignment_loss = torch.stack(alignment_loss).mean()
+        target_bboxes = F.pad(
+            target_bboxes, (0, 0, 0, max(num_queries - target_bboxes.size(1), 0))
+        )[:, :num_queries]
+        gnd_alignment = utils.get_grounding_alignment(
+            target_bboxes, object_regions[..., :4], num_query, num_objects
+        )
+        alignment_mask = (
+            losses.query_mask(num_query, grounding_matrix.size(1))[:, :, None]
+            & losses.query_mask(num_objects, grounding_matrix.size(2))[:, None, :]
+        )
+        alignment_loss = losses.batched_ce_loss(
+            grounding_matrix, gnd_alignment.to(grounding_matrix.dtype), alignment_mask
+        ).mean()
         if args.bbox_reg:
             ssl_loss = (reg_loss+ loss_mlm + ceLoss(probs, target_pred))
 
@@ -209,6 +147,16 @@ def ssl_train(model, ssl_loader, ssl_train_iter, device, optimizer, args, lr=):
     return ssl_loss
 
 
+def run_evaluation(eval_loader, model, device, args):
+    was_training = model.training
+    score = evaluate(eval_loader, model, device, args)
+    model.train(was_training)
+
+    metrics = utils.MetricAccumulator(["score"], device=device)
+    metrics.update("score", score, len(eval_loader))
+    return metrics.all_reduce().compute()["score"]
+
+
 def train_model(
     model,
     ema_model,
@@ -220,9 +168,10 @@ def train_model(
     lr=1e-4,
     epochs=25,
 ):
-    use_gpu = torch.cuda.is_available()
     model = model.float()
-   
+    teacher_cache = None
+    if args.label_prop and args.teacher_source == "ema":
+        teacher_cache = pseudo_label.TeacherCache(args.teacher_refresh)
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.01)
    
@@ -231,6 +180,14 @@ def train_model(
         optimizer, multiplier=1, total_epoch=2, after_scheduler=scheduler_steplr
     )
     
+    # step evaluations draw --eval-batches random test batches per call
+    sample_eval_loader = eval_cache.eval_subset(test_loader, args.eval_batches)
+    stream = dual_loader.DualStreamLoader(
+        train_loader,
+        ssl_loader if args.use_ssl else None,
+        ssl_ratio=args.ssl_ratio,
+    )
+    global_step = 0
     for epoch in range(epochs):
         scheduler_warmup.step(epoch)
         t = time.time()
@@ -239,102 +196,50 @@ def train_model(
 
         total_loss = 0
         n_batches = 0
-        if args.distributed:
-            train_loader.sampler.set_epoch(epoch)
-            ssl_loader.sampler.set_epoch(epoch)
-
-        if args.use_ssl:
-            ssl_iter = iter(ssl_loader)
-
-        for (
-            idx,
-            phrase_queries,
-            image_features,
-            object_label_input_ids,
-            object_label_attention_mask,
-            object_regions,
-            phrase_queries_input_ids,
-            phrase_queries_attention_mask,
-            caption_input_ids,
-            caption_attn_masks,
-            sense2vec_feats,
-            query_start_end,
-            num_objects,
-            num_query,
-            target_bboxes,
-            mouse_trace_for_phrases,
-            mouse_trace_feats,
-            gt_coref_matrix,
-            rule_coref_matrix,
-        ) in tqdm(train_loader):
-            if use_gpu:
-                (
-                    idx,
-                    image_features,
-                    object_label_input_ids,
-                    object_label_attention_mask,
-                    object_regions,
-                    phrase_queries_input_ids,
-                    phrase_queries_attention_mask,
-                    caption_input_ids,
-                    caption_attn_masks,
-                    sense2vec_feats,
-                    query_start_end,
-                    num_objects,
-                    num_query,
-                    target_bboxes,
-                    mouse_trace_for_phrases,
-                    mouse_trace_feats,
-                    gt_coref_matrix,
-                    rule_coref_matrix,
-                ) = (
-                    idx.to(device),
-                    image_features.to(device),
-                    object_label_input_ids.to(device),
-                    object_label_attention_mask.to(device),
-                    object_regions.to(device),
-                    phrase_queries_input_ids.to(device),
-                    phrase_queries_attention_mask.to(device),
-                    caption_input_ids.to(device),
-                    caption_attn_masks.to(device),
-                    sense2vec_feats.to(device),
-                    query_start_end.to(device),
-                    num_objects.to(device),
-                    num_query.to(device),
-                    target_bboxes.to(device),
-                    mouse_trace_for_phrases.to(device),
-                    mouse_trace_feats.to(device),
-                    gt_coref_matrix.to(device),
-                    rule_coref_matrix.to(device),
-                )
+        stream.set_epoch(epoch)
+
+        for batch, ssl_batches in tqdm(stream):
+            batch = batch.to(device, non_blocking=True)
             model.train(True)
             optimizer.zero_grad()
-            mouse_trace_for_phrases = mouse_trace_for_phrases.squeeze(-2)
 
-            if args.use_ssl:
-                try:
-                    ssl_loss = ssl_train(
-                        model, ssl_loader, ssl_iter, device, optimizer, args
-                    )
-                except:
-                    ssl_iter = iter(ssl_loader)
-                    ssl_loss = ssl_train(
-                        model, ssl_loader, ssl_iter, device, optimizer, args
-                    )
+            if len(ssl_batches) > 0:
+                ssl_loss = sum(
+                    ssl_train(model, ssl_batch, device, optimizer, args)
+                    for ssl_batch in ssl_batches
+                ) / len(ssl_batches)
             n_batches += 1
 
-            caption_input_ids = caption_input_ids.squeeze(1)
-            caption_attn_masks = caption_attn_masks.squeeze(1)
-            phrase_queries_input_ids = phrase_queries_input_ids.squeeze(2)
-            phrase_queries_attention_mask = phrase_queries_attention_mask.squeeze(2)
-          
-            object_label_input_ids = object_label_input_ids.squeeze(-2)
-            object_label_attention_mask = object_label_attention_mask.squeeze(-2)
-            object_label_input_ids = object_label_input_ids.view(-1, 16)
-            object_label_attention_mask = object_label_attention_mask.view(-1, 16)
-            if args.label_prop:
+            image_features = batch.image_features
+            object_regions = batch.object_regions
+            sense2vec_feats = batch.sense2vec_feats
+            query_start_end = batch.query_start_end
+            num_objects = batch.num_objects
+            num_query = batch.num_query
+            caption_input_ids = batch.caption_input_ids.squeeze(1)
+            caption_attn_masks = batch.caption_attn_mask.squeeze(1)
+            object_label_input_ids = batch.object_label_input_ids.squeeze(-2).view(
+                -1, 16
+            )
+            object_label_attention_mask = (
+                batch.object_label_attention_mask.squeeze(-2).view(-1, 16)
+            )
+            teacher_targets = None
+            if teacher_cache is not None:
+                teacher_targets = teacher_cache.lookup(
+                    batch.image_id,
+                    epoch,
+                    query_start_end.size(1),
+                    image_features.size(1),
+                    device,
+                )
+            if teacher_targets is not None:
+                gt_grounding_matrix, pred_gt_coref_matrix = teacher_targets
+            elif args.label_prop:
+                teacher = model if args.teacher_source == "forward" else ema_model.ema
                 with torch.no_grad():
                     (
+                        _,
                         _,
                         gt_grounding_matrix,
                         pred_gt_coref_matrix,
@@ -349,7 +254,7 @@ def train_model(
                         _,
                         _,
                         modified_pred_boxes,
-                    ) = model.forward(
+                    ) = teacher.forward(
                         image_features,
                         object_label_input_ids,
                         object_label_attention_mask,
@@ -360,13 +265,22 @@ def train_model(
                         query_start_end,
                         num_objects,
                         num_query,
-                        mouse_trace_feats,
-                        phrase_queries_input_ids=phrase_queries_input_ids,
                         max_assignments=None,
                         train=False,
+                        inference=True,
+                    )
+                if teacher_cache is not None:
+                    teacher_cache.store(
+                        batch.image_id,
+                        epoch,
+                        gt_grounding_matrix,
+                        pred_gt_coref_matrix,
+                        num_query,
+                        num_objects,
                     )
             (
                 loss_mlm,
+                _,
                 grounding_matrix,
                 pred_coref_matrix,
                 weighted_phrase_embedding,
@@ -391,8 +305,6 @@ def train_model(
                 query_start_end,
                 num_objects,
                 num_query,
-                mouse_trace_feats,
-                phrase_queries_input_ids=phrase_queries_input_ids,
             )
             target_pred = torch.argmax(target, dim=1)
             prediction = torch.argmax(probs, dim=1)
@@ -408,106 +320,52 @@ def train_model(
             if args.label_prop:
                 if args.ssl_loss == "sigmoid":
                     gt_coref_matrix = (pred_gt_coref_matrix > 0.5).float()
-                    batch_reg_loss = [
-                        losses.bce_loss(
-                            weighted_phrase_embedding[b][: num_query[b], :],
-                            gt_coref_matrix[b][: num_query[b], : num_query[b]],
-                        )
-                        for b in range(len(gt_coref_matrix))
-                    ]
-                    reg_loss = torch.stack(batch_reg_loss).mean()
+                    batch_reg_loss = losses.batched_bce_loss(
+                        weighted_phrase_embedding, gt_coref_matrix, num_query
+                    )
+                    reg_loss = batch_reg_loss.mean()
                 else:
                     gt_coref_matrix = (pred_gt_coref_matrix > current_threshold).float()
 
-                    batch_reg_loss = [
-                        smooth_loss_unlabeled(
-                            weighted_phrase_embedding[b][: num_query[b], :],
-                            torch.mean(
-                                weighted_phrase_embedding[b][: num_query[b], : num_query[b]].to(torch.float),
-                                dim=0
-                            ),
-                            torch.mean(
-                                weighted_phrase_embedding[b][: num_query[b], : num_query[b]].logical_not().to(
-                                    torch.float),
-                                dim=0
-                            ),
-                        )
-                        for b in range(len(gt_coref_matrix))
-                    ]
-                    
-                    batch_reg_loss = torch.stack(batch_reg_loss)
+                    batch_reg_loss = smooth_loss_unlabeled.forward_batched(
+                        weighted_phrase_embedding, num_query
+                    )
                     reg_loss = batch_reg_loss.mean()
                 if args.grounding:
-                    gt_grounding_matrix = gt_grounding_matrix.float()
-                    maxval, _ = gt_grounding_matrix.max(dim=-1, keepdim=True)
-                    gt_grounding_matrix = (
-                        gt_grounding_matrix == maxval
+                    reg_g_loss, reg_g_loss1 = losses.grounding_pseudo_label_loss(
+                        grounding_matrix, gt_grounding_matrix, num_query
                     )
-                    gt_grounding_matrix = gt_grounding_matrix.long()
-                    batch_reg_g_loss = []
-                    batch_reg_g_loss1 = []
-                    for b in range(len(gt_grounding_matrix)):
-                        b_gt_grounding_matrix = []
-                        b_grounding_matrix = []
-                        for q in range(num_query[b]):
-                            if maxval[b][q][0] > 0.01:
-                                b_gt_grounding_matrix.append(
-                                    gt_grounding_matrix[b][q]
-                                )
-                                b_grounding_matrix.append(
-                                    grounding_matrix[b][q]
-                                )
-                        if len(b_grounding_matrix) > 0:
-                            b_grounding_matrix = torch.stack(
-                                b_grounding_matrix
-                            ).to(device)
-                            b_gt_grounding_matrix = torch.stack(
-                                b_gt_grounding_matrix
-                            ).to(device)
-                            reg_g_loss = losses.ce_loss(
-                                b_grounding_matrix, b_gt_grounding_matrix
-                            )
-
-                            reg_g_loss1 = losses.smooth_loss1(b_grounding_matrix, b_gt_grounding_matrix)
-
-                            batch_reg_g_loss.append(reg_g_loss)
-                            if not torch.isinf(reg_g_loss1):
-                                batch_reg_g_loss1.append(reg_g_loss1)
-                                batch_reg_g_loss1 = torch.stack(batch_reg_g_loss1)
-
-                    if len(batch_reg_g_loss) > 0:
-                        batch_reg_g_loss = torch.stack(batch_reg_g_loss)
-
-                        if not torch.isinf(reg_g_loss1):
-
-                            reg_loss = (
-                                    batch_reg_loss.mean() + (batch_reg_g_loss).mean() + (
-                                batch_reg_g_loss1).mean()
-                            )
-                        else:
-                            reg_loss = (
-                                    batch_reg_loss.mean() + (batch_reg_g_loss).mean()
-                            )
+                    reg_loss = reg_loss + reg_g_loss + reg_g_loss1
 
                 loss = ceLoss(probs, target_pred) + reg_loss
 
             else:
                 loss = ceLoss(probs, target_pred)
             if args.use_ssl:
-                loss = loss + ssl_loss + loss_mlm
+                loss = loss + loss_mlm
+            if len(ssl_batches) > 0:
+                loss = loss + ssl_loss
 
             total_loss += loss
 
             loss.backward()
             optimizer.step()
 
-            if args.use_ema:
+            if args.use_ema or args.teacher_source == "ema":
                 ema_model.update(model)
+            global_step += 1
+
+            if args.eval_every > 0 and global_step % args.eval_every == 0:
+                score = run_evaluation(
+                    sample_eval_loader(global_step), model, device, args
+                )
+                print("step", global_step, "eval score:", score)
+                logging.info("step %d eval score: %f", global_step, score)
             
         
         total_loss = total_loss.item() / n_batches
 
-        score = evaluate(test_loader, model, device, args)
+        score = run_evaluation(test_loader, model, device, args)
         print("untrained eval score:", score)
 
         t1 = time.time()
@@ -525,6 +383,12 @@ def train_model(
         logging.info("     time: %f", t1 - t)
         logging.info("     total loss: %f", total_loss)
         logging.info("     supervised accuracy on training set: %f", correct_preds / all_preds)
+        for name, loader in (("train", train_loader), ("ssl", ssl_loader)):
+            stats = getattr(loader, "stats", None)
+            if stats is not None:
+                print("     %s prefetch:" % name, stats.summary())
+                logging.info("     %s prefetch: %s", name, stats.summary())
+                stats.reset()
 
 
 
@@ -541,4 +405,5 @@ def train_model(
                 else ema_model.ema
             )
         torch.save(model_to_save.state_dict(), save_path)
+    stream.close()
         
@@ -1,6 +1,69 @@
+import numpy as np
+
+
+def _as_boxes(boxList):
+    return np.asarray(boxList, dtype=np.float64).reshape(-1, 4)
+
+
+def paired_iou(boxes1, boxes2):
+    # IoU of boxes1[i] and boxes2[i], with the inclusive pixel (+1) convention
+    boxes1 = _as_boxes(boxes1)
+    boxes2 = _as_boxes(boxes2)
+    w1 = boxes1[:, 2] - boxes1[:, 0] + 1
+    h1 = boxes1[:, 3] - boxes1[:, 1] + 1
+    w2 = boxes2[:, 2] - boxes2[:, 0] + 1
+    h2 = boxes2[:, 3] - boxes2[:, 1] + 1
+    left_top = np.maximum(boxes1[:, :2], boxes2[:, :2])
+    right_bottom = np.minimum(boxes1[:, 2:], boxes2[:, 2:])
+    overlap = np.maximum(0, right_bottom - left_top + 1)
+    intersect = overlap[:, 0] * overlap[:, 1]
+    union = w1 * h1 + w2 * h2 - intersect
+    return intersect / union
+
+
+def candidate_iou(candidatesList, gtBoxList):
+    """N x K IoU matrix between each ground truth box and its K candidates.
+
+    Instances with fewer than K candidates are padded with -inf.
+    """
+    counts = np.array([len(candidates) for candidates in candidatesList], dtype=np.int64)
+    n_rows = len(counts)
+    n_cols = int(counts.max()) if n_rows > 0 else 0
+    iou = np.full((n_rows, n_cols), -np.inf)
+    if n_cols == 0:
+        return iou
+    rows = np.repeat(np.arange(n_rows), counts)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    candidates = np.concatenate([_as_boxes(c) for c in candidatesList if len(c) > 0])
+    iou[rows, cols] = paired_iou(candidates, _as_boxes(gtBoxList)[rows])
+    return iou
+
+
 class Evaluator(object):
+    """Phrase grounding accuracy from arrays of IoUs.
+
+    The evaluate* methods score a full prediction list at once. For streaming
+    use, call update (or update_upperbound) once per batch and summarize at
+    the end; the two modes cannot be mixed between resets.
+    """
+
     def __init__(self):
-        pass
+        self.reset()
+
+    def reset(self):
+        self._ious = []
+        self._argmaxes = []
+        self._categories = []
+        self._mode = None
+
+    def _set_mode(self, mode):
+        if self._mode is not None and self._mode != mode:
+            raise ValueError(
+                "Evaluator holds %s updates, call reset() before %s updates"
+                % (self._mode, mode)
+            )
+        self._mode = mode
+
     def compute_iou(self, predictedBoxList, gtBoxList):
         assert len(predictedBoxList) == len(
             gtBoxList
@@ -8,21 +71,38 @@ class Evaluator(object):
             len(predictedBoxList), len(gtBoxList)
         )
 
-        iouList = []
-        for box1, box2 in zip(gtBoxList, predictedBoxList):
-            iou = self._iou(box1, box2)
-            iouList.append(iou)
-
-        return iouList
+        return paired_iou(gtBoxList, predictedBoxList).tolist()
 
     def accuracy(self, iouList, iouThreshold=0.5):
 
-        matches = len([1 for iou in iouList if iou >= iouThreshold])
+        matches = int(np.count_nonzero(np.asarray(iouList) >= iouThreshold))
         accuracy = matches * 1.0 / len(iouList)
         return accuracy
 
-    def evaluate(self, predictedBoxList, gtBoxList, iouThreshold=0.5):
+    def perclass_accuracy(self, iouList, boxCategoriesList, iouThreshold=0.5):
+        # a box counts once per category, however often its list repeats it
+        boxCategoriesList = [
+            sorted(set(categoryList)) for categoryList in boxCategoriesList
+        ]
+        box_index = np.repeat(
+            np.arange(len(boxCategoriesList)),
+            [len(categoryList) for categoryList in boxCategoriesList],
+        )
+        categories = [
+            category for categoryList in boxCategoriesList for category in categoryList
+        ]
+        if len(categories) == 0:
+            return {}
+        categorySet, codes = np.unique(np.asarray(categories), return_inverse=True)
+        hits = (np.asarray(iouList) >= iouThreshold)[box_index]
+        matches = np.bincount(codes, weights=hits, minlength=len(categorySet))
+        totals = np.bincount(codes, minlength=len(categorySet))
+        return {
+            category: float(matches[i] / totals[i])
+            for i, category in enumerate(categorySet.tolist())
+        }
 
+    def evaluate(self, predictedBoxList, gtBoxList, iouThreshold=0.5):
 
         iouList = self.compute_iou(predictedBoxList, gtBoxList)
         accuracy = self.accuracy(iouList, iouThreshold)
@@ -32,24 +112,9 @@ class Evaluator(object):
         self, predictedBoxList, gtBoxList, boxCategoriesList, iouThreshold=0.5
     ):
 
-        categorySet = set()
-        for categoryList in boxCategoriesList:
-            categorySet.update(categoryList)
-
         iouList = self.compute_iou(predictedBoxList, gtBoxList)
         accuracy = self.accuracy(iouList, iouThreshold)
-        perClassAccDict = {}
-        for category in categorySet:
-            subPredictedBoxList = []
-            subGtBoxList = []
-            for pred, gt, categoryList in zip(
-                predictedBoxList, gtBoxList, boxCategoriesList
-            ):
-                if category in categoryList:
-                    subPredictedBoxList.append(pred)
-                    subGtBoxList.append(gt)
-            subIouList = self.compute_iou(subPredictedBoxList, subGtBoxList)
-            perClassAccDict[category] = self.accuracy(subIouList, iouThreshold)
+        perClassAccDict = self.perclass_accuracy(iouList, boxCategoriesList, iouThreshold)
 
         return (accuracy, perClassAccDict, iouList)
 
@@ -57,65 +122,42 @@ class Evaluator(object):
         self, predictedBoxList, gtBoxList, boxCategoriesList, iouThreshold=0.5
     ):
 
-        categorySet = set()
-        for categoryList in boxCategoriesList:
-            categorySet.update(categoryList)
-
-        iouList = []
-        argmaxList = []
-        for i, gtBox in enumerate(gtBoxList):
-            nCandidates = len(predictedBoxList[i])
-            replicatedGtBoxList = []
-            for j in range(nCandidates):
-                replicatedGtBoxList.append(gtBox)
-            instanceIouList = self.compute_iou(predictedBoxList[i], replicatedGtBoxList)
-            maxIou = max(instanceIouList)
-            iouList.append(maxIou)
-            argmaxList.append(instanceIouList.index(maxIou))
+        iou = candidate_iou(predictedBoxList, gtBoxList)
+        iouList = iou.max(axis=1).tolist()
+        argmaxList = iou.argmax(axis=1).tolist()
         accuracy = self.accuracy(iouList, iouThreshold)
-        perClassAccDict = {}
-        for category in categorySet:
-            subPredictedBoxList = []
-            subGtBoxList = []
-            for pred, gt, categoryList in zip(
-                predictedBoxList, gtBoxList, boxCategoriesList
-            ):
-                if category in categoryList:
-                    subPredictedBoxList.append(pred)
-                    subGtBoxList.append(gt)
-            subIouList = []
-            for i, subGtBox in enumerate(subGtBoxList):
-                nCandidates = len(subPredictedBoxList[i])
-                replicatedGtBoxList = []
-                for j in range(nCandidates):
-                    replicatedGtBoxList.append(subGtBox)
-                instanceIouList = self.compute_iou(
-                    subPredictedBoxList[i], replicatedGtBoxList
-                )
-                maxIou = max(instanceIouList)
-                subIouList.append(maxIou)
-
-            perClassAccDict[category] = self.accuracy(subIouList, iouThreshold)
+        perClassAccDict = self.perclass_accuracy(iouList, boxCategoriesList, iouThreshold)
 
         return (accuracy, perClassAccDict, iouList, argmaxList)
 
-    def _iou(self, box1, box2):
-        (box1_left_x, box1_top_y, box1_right_x, box1_bottom_y) = box1
-        box1_w = box1_right_x - box1_left_x + 1
-        box1_h = box1_bottom_y - box1_top_y + 1
-
-        (box2_left_x, box2_top_y, box2_right_x, box2_bottom_y) = box2
-        box2_w = box2_right_x - box2_left_x + 1
-        box2_h = box2_bottom_y - box2_top_y + 1
-        intersect_left_x = max(box1_left_x, box2_left_x)
-        intersect_top_y = max(box1_top_y, box2_top_y)
-        intersect_right_x = min(box1_right_x, box2_right_x)
-        intersect_bottom_y = min(box1_bottom_y, box2_bottom_y)
-
-        overlap_x = max(0, intersect_right_x - intersect_left_x + 1)
-        overlap_y = max(0, intersect_bottom_y - intersect_top_y + 1)
-        intersect = overlap_x * overlap_y
-
-        union = (box1_w * box1_h) + (box2_w * box2_h) - intersect
+    def update(self, predictedBoxList, gtBoxList, boxCategoriesList=None):
+        self._set_mode("paired")
+        self._ious.append(np.asarray(self.compute_iou(predictedBoxList, gtBoxList)))
+        self._extend_categories(len(gtBoxList), boxCategoriesList)
+
+    def update_upperbound(self, predictedBoxList, gtBoxList, boxCategoriesList=None):
+        self._set_mode("upperbound")
+        iou = candidate_iou(predictedBoxList, gtBoxList)
+        self._ious.append(iou.max(axis=1))
+        self._argmaxes.append(iou.argmax(axis=1))
+        self._extend_categories(len(gtBoxList), boxCategoriesList)
+
+    def _extend_categories(self, n_boxes, boxCategoriesList):
+        if boxCategoriesList is None:
+            boxCategoriesList = [[]] * n_boxes
+        self._categories.extend(boxCategoriesList)
+
+    def summarize(self, iouThreshold=0.5):
+        """Return (accuracy, perClassAccDict, iouList[, argmaxList]) of all updates."""
+        iouList = np.concatenate(self._ious).tolist() if self._ious else []
+        accuracy = self.accuracy(iouList, iouThreshold)
+        perClassAccDict = self.perclass_accuracy(
+            iouList, self._categories, iouThreshold
+        )
+        if self._argmaxes:
+            argmaxList = np.concatenate(self._argmaxes).tolist()
+            return (accuracy, perClassAccDict, iouList, argmaxList)
+        return (accuracy, perClassAccDict, iouList)
 
-        return intersect * 1.0 / union
+    def _iou(self, box1, box2):
+        return float(paired_iou([box1], [box2])[0])
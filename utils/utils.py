@@ -137,46 +137,90 @@ def get_intersection(obj1, obj2):
     return [left, top, right, bottom]
 
 
+def as_bboxes(bboxes, device=None):
+    if isinstance(bboxes, (list, tuple)) and len(bboxes) > 0 and torch.is_tensor(bboxes[0]):
+        bboxes = torch.stack(list(bboxes))
+    bboxes = torch.as_tensor(bboxes, device=device)
+    if bboxes.numel() == 0:
+        return torch.zeros((0, 4), device=bboxes.device)
+    if not bboxes.is_floating_point():
+        bboxes = bboxes.float()
+    return bboxes
+
+
+def pairwise_iou(src_bboxes, dst_bboxes):
+    """IoU of every src/dst pair, (..., Q, 4) x (..., O, 4) -> (..., Q, O).
+
+    Same convention as calculate_iou: boxes are [left, top, right, bottom] and
+    only the first four columns are used.
+    """
+    EPS = 1e-6
+    src_bboxes = as_bboxes(src_bboxes)
+    dst_bboxes = as_bboxes(dst_bboxes, device=src_bboxes.device)
+    src = src_bboxes[..., :, None, :4]
+    dst = dst_bboxes[..., None, :, :4]
+    left_top = torch.max(src[..., :2], dst[..., :2])
+    right_bottom = torch.min(src[..., 2:], dst[..., 2:])
+    wh = (right_bottom - left_top).clamp(min=0)
+    area_int = wh[..., 0] * wh[..., 1]
+    area1 = calculate_area(src.unbind(-1))
+    area2 = calculate_area(dst.unbind(-1))
+    return area_int / ((area1 + area2 - area_int) + EPS)
+
+
+def length_mask(lengths, size):
+    return torch.arange(size, device=lengths.device) < lengths[..., None]
+
+
+def masked_argmax(scores, mask, dim=-1):
+    """Argmax over the entries where mask is set; valid is False where none are."""
+    scores = scores.masked_fill(~mask, float("-inf"))
+    return scores.argmax(dim=dim), mask.any(dim=dim)
+
+
+def coref_matrix(cluster_ids, dtype=torch.float):
+    """(..., Q, Q) coreference matrix from (..., Q) cluster ids, -1 meaning none."""
+    same = cluster_ids.unsqueeze(-1) == cluster_ids.unsqueeze(-2)
+    return (same & (cluster_ids >= 0).unsqueeze(-1)).to(dtype)
+
+
 def get_match_index(src_bboxes, dst_bboxes):
-    indices = set()
-    for src_bbox in src_bboxes:
-        for i, dst_bbox in enumerate(dst_bboxes):
-            iou = calculate_iou(src_bbox, dst_bbox)
-            if iou >= 0.5:
-                indices.add(i)
-    return list(indices)
+    iou = pairwise_iou(src_bboxes, dst_bboxes)
+    return (iou >= 0.5).any(dim=0).nonzero().flatten().tolist()
 
 
-def get_grounding_alignment(src_bboxes, dst_bboxes):
-    alignment = torch.zeros((len(src_bboxes), len(dst_bboxes)))
-    for i, src_bbox in enumerate(src_bboxes):
-        for j, dst_bbox in enumerate(dst_bboxes):
-            iou = calculate_iou(src_bbox, dst_bbox)
-            alignment[i][j] = iou
+def get_grounding_alignment(src_bboxes, dst_bboxes, num_src=None, num_dst=None):
+    """Boolean (..., Q, O) matrix marking the best-IoU dst boxes of each src box.
 
-    maxval, _ = alignment.max(dim=-1, keepdim=True)
-    predictions = alignment == maxval
-    return predictions
+    Batched inputs take num_src / num_dst to mask out padded boxes; rows of
+    padded src boxes are all False.
+    """
+    alignment = pairwise_iou(src_bboxes, dst_bboxes)
+    mask = torch.ones_like(alignment, dtype=torch.bool)
+    if num_src is not None:
+        mask = mask & length_mask(num_src, alignment.size(-2))[..., :, None]
+    if num_dst is not None:
+        mask = mask & length_mask(num_dst, alignment.size(-1))[..., None, :]
+    best, valid = masked_argmax(alignment, mask)
+    maxval = alignment.gather(-1, best.unsqueeze(-1))
+    # every dst box tied with the best one is marked
+    return (alignment == maxval) & mask & valid.unsqueeze(-1)
 
 
 def bbox_is_match(src_bbox, dst_bboxes):
-    for i, dst_bbox in enumerate(dst_bboxes):
-        iou = calculate_iou(src_bbox, dst_bbox)
-        if iou >= 0.5:
-            return True
-    return False
+    if len(dst_bboxes) == 0:
+        return False
+    iou = pairwise_iou(as_bboxes(src_bbox)[None], dst_bboxes)
+    return bool((iou >= 0.5).any())
 
 
 def unsupervised_get_match_index(src_bboxes, dst_bboxes):
-
-    indices = set()
-    for entity, src_bboxes_list in src_bboxes.items():
-        for src_bbox in src_bboxes_list:
-            for i, dst_bbox in enumerate(dst_bboxes):
-                iou = calculate_iou(src_bbox, dst_bbox)
-                if iou >= 0.5:
-                    indices.add(i)
-    return list(indices)
+    src_bboxes = [
+        src_bbox
+        for src_bboxes_list in src_bboxes.values()
+        for src_bbox in src_bboxes_list
+    ]
+    return get_match_index(src_bboxes, dst_bboxes)
 
 
 
@@ -223,6 +267,31 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+class MetricAccumulator(object):
+    """Weighted metric sums that can be summed across ranks before averaging."""
+
+    def __init__(self, names, device=None):
+        self.names = list(names)
+        self.totals = torch.zeros((len(self.names), 2), dtype=torch.float64, device=device)
+
+    def update(self, name, value, count=1):
+        i = self.names.index(name)
+        self.totals[i, 0] += float(value) * count
+        self.totals[i, 1] += count
+
+    def all_reduce(self):
+        if is_dist_avail_and_initialized():
+            dist.all_reduce(self.totals)
+        return self
+
+    def compute(self):
+        totals = self.totals.tolist()
+        return {
+            name: (total / count if count > 0 else 0.0)
+            for name, (total, count) in zip(self.names, totals)
+        }
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)